@@ -0,0 +1,310 @@
+"""
+Asyncio runtime for the bot
+Long polling, replies, the sheet refresh and the scheduled message
+all run as coroutines on one event loop
+Run with `python aio_bot.py` instead of `python bot.py`
+"""
+
+import asyncio
+import concurrent.futures
+import os
+import time
+from datetime import datetime, timedelta
+
+import aiohttp
+import telegram
+from telegram.utils.helpers import DefaultValue
+
+import bot
+import metrics
+from analytics import AnalyticsWriter
+from google_sheet_to_json import fetch_delta_async, remember
+
+import logging
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+POLL_TIMEOUT = 10
+
+
+def api_error(status, data):
+    """
+    The exception PTB raises for a failed call, so the handlers
+    tell a chat that blocked the bot from a message it refused
+    """
+    message = data.get("description", "Unknown")
+    if status == 429:
+        return telegram.error.RetryAfter(data["parameters"]["retry_after"])
+    if status in (401, 403):
+        return telegram.error.Unauthorized(message)
+    if status == 400:
+        return telegram.error.BadRequest(message)
+    if status == 409:
+        return telegram.error.Conflict(message)
+    return telegram.error.NetworkError(f"{message} ({status})")
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error(f"Send failed : {future.exception()}")
+
+
+class AsyncBot:
+    """
+    Minimal asyncio client for the Telegram Bot API
+    `send_message` and `send_chat_action` can be called from the
+    synchronous handlers in `bot.py`, the call is started on the loop
+    """
+
+    def __init__(self, token, session, base_url=API_URL):
+        self.url = f"{base_url}{token}/"
+        self.session = session
+        self.loop = asyncio.get_running_loop()
+        # Read by `Message.reply_text`
+        self.defaults = None
+
+    async def call(self, method, **params):
+        """
+        Call an API method and return its result
+        """
+        payload = {}
+        for key, value in params.items():
+            value = DefaultValue.get_value(value)
+            if value is None or key == "api_kwargs":
+                continue
+            if isinstance(value, telegram.TelegramObject):
+                value = value.to_dict()
+            payload[key] = value
+
+        async with self.session.post(self.url + method, json=payload) as response:
+            data = await response.json(content_type=None)
+        if not data.get("ok"):
+            raise api_error(data.get("error_code", response.status), data)
+        return data["result"]
+
+    async def get_updates(self, offset, timeout=POLL_TIMEOUT):
+        # Long poll, the session's timeout is longer than this
+        result = await self.call("getUpdates", offset=offset, timeout=timeout)
+        return [telegram.Update.de_json(u, self) for u in result]
+
+    def _start(self, coro):
+        """
+        Start the call on the loop, from the loop thread or a worker thread
+        """
+        try:
+            on_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            future = self.loop.create_task(coro)
+        else:
+            future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(_log_failure)
+
+        pending = bot.PENDING_SENDS.get()
+        if pending is not None:
+            pending.append(future)
+        return future
+
+    def send_message(self, chat_id, text, **kwargs):
+        # PTB's client side request timeout, not an API parameter
+        kwargs.pop("timeout", None)
+        return self._start(
+            self.call("sendMessage", chat_id=chat_id, text=text, **kwargs)
+        )
+
+    def send_chat_action(self, chat_id, action, **kwargs):
+        kwargs.pop("timeout", None)
+        return self._start(
+            self.call("sendChatAction", chat_id=chat_id, action=action, **kwargs)
+        )
+
+
+class AsyncRuntime:
+    """
+    Run the bot on one event loop
+    Updates are handled concurrently, in order within a chat
+    """
+
+    def __init__(self, client, session, lytics=None):
+        self.client = client
+        self.session = session
+        self.lytics = lytics
+        self.slots = asyncio.Semaphore(bot.MAX_PENDING_UPDATES)
+        self.progress = asyncio.Event()
+        self.in_flight = set()
+        self.next_offset = 0
+        self.chat_tails = {}
+        self.first_refresh = asyncio.Event()
+        self.last_refresh = None
+
+    async def handle(self, update, previous):
+        """
+        Handle one update once the previous update of its chat is done
+        """
+        if previous is not None:
+            await asyncio.wait([previous])
+
+        pending = []
+        bot.PENDING_SENDS.set(pending)
+        try:
+            await asyncio.to_thread(bot.handle_update, self.client, update)
+        except Exception as e:
+            logging.error(f"Update {update.update_id} failed : {e}")
+        # Wait for the replies so the next update of the chat comes after them
+        # Failures are logged as they happen, not raised here
+        await asyncio.gather(
+            *(
+                (
+                    asyncio.wrap_future(f)
+                    if isinstance(f, concurrent.futures.Future)
+                    else f
+                )
+                for f in pending
+            ),
+            return_exceptions=True,
+        )
+        if self.lytics:
+            bot.log_usage(self.lytics, update)
+
+    async def dispatch(self, update):
+        """
+        Start handling the update, returns False if it was already dispatched
+        """
+        if update.update_id < self.next_offset:
+            return False
+        await self.slots.acquire()
+        self.in_flight.add(update.update_id)
+        self.next_offset = update.update_id + 1
+        logging.info(f"Update ID:{update.update_id + 1}")
+
+        chat_id = update.effective_chat.id if update.effective_chat else 0
+        task = asyncio.create_task(self.handle(update, self.chat_tails.get(chat_id)))
+        self.chat_tails[chat_id] = task
+
+        def done(_):
+            self.in_flight.discard(update.update_id)
+            self.slots.release()
+            if self.chat_tails.get(chat_id) is task:
+                del self.chat_tails[chat_id]
+            self.progress.set()
+
+        task.add_done_callback(done)
+        return True
+
+    def offset(self):
+        """
+        Every update below the offset has been processed
+        """
+        return min(self.in_flight) if self.in_flight else self.next_offset
+
+    async def poll(self):
+        while True:
+            try:
+                updates = await self.client.get_updates(self.offset())
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.error(f"Polling failed : {e}")
+                await asyncio.sleep(1)
+                continue
+            except telegram.error.TelegramError as e:
+                logging.error(f"Polling failed : {e}")
+                await asyncio.sleep(1)
+                continue
+
+            submitted = [u for u in updates if await self.dispatch(u)]
+            bot.STATE.update(offset=self.offset())
+            if updates and not submitted:
+                # Only updates still being processed came back
+                self.progress.clear()
+                try:
+                    await asyncio.wait_for(self.progress.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def refresh(self):
+        interval = bot.DATA_UPDATE_MIN * 60
+        while True:
+            started = time.monotonic()
+            fetch_start_time = datetime.now(bot.IST)
+            try:
+                with metrics.timed("fetch"):
+                    delta, state = await fetch_delta_async(self.session)
+                await asyncio.to_thread(bot.apply_delta, delta, fetch_start_time)
+                remember(state)
+                self.last_refresh = time.monotonic()
+                logging.info(f"Refresh took {self.last_refresh - started:.2f}s")
+            except Exception as e:
+                logging.error(f"Refresh failed : {e}")
+                bot.FETCH_FAILURES.inc()
+                if self.last_refresh is not None:
+                    lag = time.monotonic() - self.last_refresh
+                    if lag > 2 * interval:
+                        logging.warning(f"Data is {lag:.0f}s old")
+            self.first_refresh.set()
+            elapsed = time.monotonic() - started
+            await asyncio.sleep(max(0, interval - elapsed))
+
+    async def schedule(self):
+        """
+        Send the scheduled message every `SCHEDULE_MSG_MIN`
+        """
+        while True:
+            scheduled_sent_time = bot.state_time("scheduled_sent_time")
+            time_now = datetime.now(bot.IST)
+            if (time_now - scheduled_sent_time) > timedelta(
+                minutes=bot.SCHEDULE_MSG_MIN
+            ):
+                try:
+                    if await asyncio.to_thread(bot.send_to_channel, self.client):
+                        logging.info("Sent scheduled message to channel")
+                except Exception as e:
+                    logging.error(f"Scheduled message failed : {e}")
+                bot.STATE.update(scheduled_sent_time=time_now.strftime(bot.TIME_FORMAT))
+            await asyncio.sleep(60)
+
+    async def run(self):
+        bot.STATE.load()
+        bot.STATE.start()
+        self.next_offset = bot.STATE.get("offset")
+        # Serve the last saved data and refresh in the background
+        await asyncio.to_thread(bot.load_status_logs)
+        refresh = asyncio.create_task(self.refresh())
+        if bot.STORE.get().status is None:
+            logging.info("Waiting for the first data refresh")
+            await self.first_refresh.wait()
+        await asyncio.gather(refresh, self.schedule(), self.poll())
+
+
+async def run(token, base_url=API_URL):
+    """
+    Run the bot until cancelled
+    """
+    timeout = aiohttp.ClientTimeout(total=POLL_TIMEOUT + 20)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        client = AsyncBot(token, session, base_url)
+        bot.start_mirror(client)
+        bot.start_subscriptions(client)
+        # Usage logs are written in batches in the background
+        lytics = AnalyticsWriter()
+        lytics.start()
+        runtime = AsyncRuntime(client, session, lytics)
+        bot.start_metrics(pending=lambda: len(runtime.in_flight), lytics=lytics)
+        await runtime.run()
+
+
+def main():
+    try:
+        BOT_TOKEN = os.environ["BOT_TOKEN"]
+    except KeyError:
+        logging.error("Bot credentials not found in environment")
+        return
+    asyncio.run(run(BOT_TOKEN))
+
+
+if __name__ == "__main__":
+    main()
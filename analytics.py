@@ -1,6 +1,13 @@
 import pandas as pd
 import json
+import os
+import queue
+import random
+import threading
+import time
+import atexit
 import gspread
+import metrics
 from oauth2client.service_account import ServiceAccountCredentials
 
 import logging
@@ -53,3 +60,161 @@ class Analytics():
         r = self.sheet.append_rows(rows)
         logging.info(f"{r['updates']['updatedRows']} row(s) updated to usage logs!")
 
+
+class AnalyticsWriter():
+    """
+    Write usage log rows to the sheet in batches from a background thread
+    Rows that can't be written are spilled to a local file
+    and written once the sheet is reachable again
+    """
+    SPILL_FILE = "./usage_log_spill.jsonl"
+
+    def __init__(self, connect=Analytics, batch_size=50, flush_interval=5,
+                 max_queue=1000, max_retries=3, spill_file=SPILL_FILE):
+        self.connect = connect
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.spill_file = spill_file
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.lytics = None
+        self.written = 0
+        self.spilled = 0
+        self._spill_lock = threading.Lock()
+        # The batch being written, spilled by close() if it never lands
+        self._in_flight = None
+        self._flight_lock = threading.Lock()
+        self._thread = threading.Thread(target=self.run, name="analytics", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, row):
+        """
+        Queue a row without blocking, spill it if the queue is full
+        """
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            self.spill([row])
+
+    def run(self):
+        self.replay()
+        while True:
+            batch = self.next_batch()
+            if batch and self.write(batch) and os.path.exists(self.spill_file):
+                self.replay()
+
+    def next_batch(self):
+        """
+        Wait for a full batch or for `flush_interval` seconds, whichever is first
+        """
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def write(self, rows):
+        """
+        Append the rows, spilling them if they can't be written
+        Returns False if the rows had to be spilled
+        """
+        with self._flight_lock:
+            self._in_flight = rows
+        ok = self.append(rows)
+        with self._flight_lock:
+            # close() already spilled them if they are no longer in flight
+            landed = self._in_flight is rows
+            self._in_flight = None
+        if not ok and landed:
+            self.spill(rows)
+        return ok
+
+    def append(self, rows):
+        """
+        Append the rows, retrying with jittered backoff
+        Returns False if they couldn't be written
+        """
+        delay = 1
+        for attempt in range(self.max_retries):
+            try:
+                if self.lytics is None:
+                    self.lytics = self.connect()
+                with metrics.timed("append_rows"):
+                    self.lytics.append_rows(rows)
+                self.written = self.written + len(rows)
+                return True
+            except Exception as e:
+                logging.error(f"Analytics post failed : {e}")
+                self.lytics = None
+                time.sleep(delay * random.uniform(0.5, 1.5))
+                delay = delay * 2
+        return False
+
+    def spill(self, rows):
+        """
+        Save the rows locally to be written later
+        """
+        with self._spill_lock:
+            with open(self.spill_file, "a") as f:
+                for row in rows:
+                    f.write(json.dumps(row) + "\n")
+        self.spilled = self.spilled + len(rows)
+        logging.warning(f"{len(rows)} usage log row(s) spilled to {self.spill_file}")
+
+    def _read_spill(self):
+        try:
+            with open(self.spill_file, "r") as f:
+                return [line for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def replay(self):
+        """
+        Write the spilled rows a batch at a time
+        Each batch stays in the file until it is written,
+        so a failure or a crash part way loses nothing
+        """
+        with self._spill_lock:
+            rows = [json.loads(line) for line in self._read_spill()]
+        if not rows:
+            return
+        logging.info(f"Replaying {len(rows)} spilled usage log row(s)")
+        for i in range(0, len(rows), self.batch_size):
+            batch = rows[i : i + self.batch_size]
+            if not self.append(batch):
+                return
+            # Rows spilled meanwhile were appended after those read above
+            with self._spill_lock:
+                lines = self._read_spill()[len(batch) :]
+                if lines:
+                    tmp = self.spill_file + ".tmp"
+                    with open(tmp, "w") as f:
+                        f.writelines(lines)
+                    os.replace(tmp, self.spill_file)
+                else:
+                    os.remove(self.spill_file)
+
+    def close(self):
+        """
+        Spill the rows being written and those still queued
+        so they survive a restart
+        """
+        with self._flight_lock:
+            rows = list(self._in_flight or [])
+            self._in_flight = None
+        while True:
+            try:
+                rows.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if rows:
+            self.spill(rows)
@@ -0,0 +1,270 @@
+"""
+Offline micro-benchmarks of the query and render pipeline
+
+    python benchmark.py --hospitals 500 --logs 200 --out before.json
+    python benchmark.py --hospitals 500 --logs 200 --compare before.json
+
+Runs on a synthetic sheet, needs no Telegram or Google credentials
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime
+
+# bot reads its channel at import time
+os.environ.setdefault("SCHEDULE_CHANNEL", "@benchmark")
+
+import numpy as np
+import pandas as pd
+
+import bot
+from cache import ReplyCache
+from geo import CENTROIDS
+from snapshot import Snapshot
+from synthetic import sheet_columns
+
+import logging
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+PERCENTILES = [50, 90, 99]
+BEDTYPES = ["General", "HDU", "ICU", "Ventilator-ICU"]
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def measure(fn, repeat, setup=None):
+    """
+    Time `repeat` calls of `fn`, then trace one more for its peak memory
+    `setup` is called before each call, untimed, and returns the arguments
+    """
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+
+    args = setup() if setup else ()
+    tracemalloc.start()
+    try:
+        fn(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    times = np.array(times) * 1000
+    result = {f"p{p}_ms": float(np.percentile(times, p)) for p in PERCENTILES}
+    result.update(
+        {
+            "mean_ms": float(times.mean()),
+            "max_ms": float(times.max()),
+            "calls": repeat,
+            "peak_kb": peak / 1024,
+        }
+    )
+    return result
+
+
+def run(n_hospitals, n_logs, repeat, seed):
+    """
+    Benchmark each stage of the pipeline on a synthetic sheet
+    """
+    rnd = random.Random(seed)
+    columns = sheet_columns(n_hospitals, n_logs, seed)
+    results = {}
+
+    def bench(name, fn, n, setup=None):
+        logging.info(f"Benchmarking {name}")
+        results[name] = measure(fn, n, setup)
+
+    heavy = max(1, repeat // 50)
+    bench("clean_data", bot.clean_data, heavy, lambda: (columns,))
+    status = bot.clean_data(columns)
+
+    bench("snapshot", Snapshot, heavy, lambda: (status,))
+    bench(
+        "latest_logs",
+        lambda s: s.latest_logs(1),
+        heavy,
+        lambda: (Snapshot(status),),
+    )
+
+    snapshot = bot.STORE.publish(status)
+    snapshot.latest_logs(1)
+    zones = list(snapshot.by_zone)
+    pincodes = list(snapshot.by_pincode)
+
+    bench(
+        "hosps_in_zone",
+        bot.hosps_in_zone,
+        repeat,
+        lambda: (snapshot, rnd.choice(zones)),
+    )
+    bench(
+        "hosps_in_pincode",
+        bot.hosps_in_pincode,
+        repeat,
+        lambda: (snapshot, rnd.choice(pincodes)),
+    )
+    bench(
+        "hosps_in_bedtype",
+        bot.hosps_in_bedtype,
+        repeat,
+        lambda: (snapshot, rnd.choice(list(snapshot.by_bedtype))),
+    )
+
+    names = [str(h) for h in snapshot.latest_logs(1)]
+
+    def typo():
+        # A hospital name with one letter dropped
+        name = rnd.choice(names)
+        i = rnd.randrange(len(name))
+        return name[:i] + name[i + 1 :]
+
+    bench("hosps_by_name", bot.hosps_by_name, repeat, lambda: (snapshot, typo()))
+
+    located = [p for p in pincodes if p in CENTROIDS]
+    bench(
+        "hosps_near",
+        bot.hosps_near,
+        repeat,
+        lambda: (snapshot, rnd.choice(located), rnd.choice(list(snapshot.has_beds))),
+    )
+
+    latest = snapshot.latest_logs(1)
+
+    def zone_logs():
+        zone = rnd.choice(zones)
+        logs = [{"hospital": h, "logs": latest[h]} for h in snapshot.by_zone[zone]]
+        return logs, zone
+
+    bench("prepare_message", bot.prepare_message, repeat, zone_logs)
+
+    # Every reply rendered, then every reply served from the cache,
+    # which holds all of them so the cached runs only measure hits
+    warm_keys = len(zones) + len(pincodes) + len(BEDTYPES) + len(names)
+    for label, maxsize in [("uncached", 0), ("cached", warm_keys)]:
+        bot.REPLY_CACHE = ReplyCache(maxsize=maxsize)
+        if maxsize:
+            for zone in zones:
+                bot.process_zone(zone)
+            for pincode in pincodes:
+                bot.process_pincode(pincode)
+            for bedtype in BEDTYPES:
+                bot.process_bedtype(bedtype)
+            for name in names:
+                bot.process_hospital(name)
+        bench(
+            f"process_zone ({label})",
+            bot.process_zone,
+            repeat,
+            lambda: (rnd.choice(zones),),
+        )
+        bench(
+            f"process_pincode ({label})",
+            bot.process_pincode,
+            repeat,
+            lambda: (rnd.choice(pincodes),),
+        )
+        bench(
+            f"process_bedtype ({label})",
+            bot.process_bedtype,
+            repeat,
+            lambda: (rnd.choice(BEDTYPES),),
+        )
+        bench(
+            f"process_hospital ({label})",
+            bot.process_hospital,
+            repeat,
+            lambda: (rnd.choice(names),),
+        )
+
+    return {
+        "commit": git_commit(),
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "params": {
+            "hospitals": n_hospitals,
+            "logs": n_logs,
+            "rows": len(columns["rowid"]),
+            "repeat": repeat,
+            "seed": seed,
+        },
+        "results": results,
+    }
+
+
+def report(run_result, baseline=None):
+    """
+    Print the results, with the change in p50 against `baseline`
+    """
+    params = run_result["params"]
+    print(
+        f"commit {run_result['commit']} : {params['rows']} rows, "
+        f"{params['hospitals']} hospitals"
+    )
+    columns = [f"p{p}_ms" for p in PERCENTILES] + ["max_ms", "peak_kb"]
+    print(f"{'':28}" + "".join(f"{c:>12}" for c in columns) + f"{'vs base':>10}")
+    for name, r in run_result["results"].items():
+        line = f"{name:28}" + "".join(f"{r[c]:12.3f}" for c in columns)
+        if baseline and name in baseline["results"]:
+            base = baseline["results"][name]["p50_ms"]
+            if base > 0:
+                line = line + f"{r['p50_ms'] / base:9.2f}x"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--hospitals", type=int, default=500)
+    parser.add_argument("--logs", type=int, default=200, help="statuses per hospital")
+    parser.add_argument("--repeat", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--out", help="results file, benchmark-<commit>.json by default"
+    )
+    parser.add_argument("--compare", help="results file of an earlier run")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    result = run(args.hospitals, args.logs, args.repeat, args.seed)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        if baseline["params"] != result["params"]:
+            logging.warning("Comparing runs with different parameters")
+    report(result, baseline)
+
+    out = args.out or f"benchmark-{result['commit'] or 'local'}.json"
+    with open(out, "w") as f:
+        json.dump(result, f, indent=4)
+    print(f"Saved to {out}")
+
+
+if __name__ == "__main__":
+    main()
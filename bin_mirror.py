@@ -0,0 +1,113 @@
+import json
+import queue
+import random
+import threading
+import time
+
+import logging
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+
+def serialize(obj):
+    """
+    Compact JSON of a telegram object, dict or anything printable
+    """
+    if hasattr(obj, "to_dict"):
+        obj = obj.to_dict()
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+def pack(events, max_length):
+    """
+    Join serialized events into as few messages as possible,
+    each at most `max_length` characters
+    An event longer than that is cut
+    """
+    messages = []
+    current = ""
+    for event in events:
+        event = event[:max_length]
+        if current and len(current) + 1 + len(event) > max_length:
+            messages.append(current)
+            current = ""
+        current = current + "\n" + event if current else event
+    if current:
+        messages.append(current)
+    return messages
+
+
+class BinMirror:
+    """
+    Mirror updates and replies to the BIN channel from a background thread
+    Events are packed into messages of up to `max_length` characters
+    """
+
+    def __init__(
+        self,
+        bot,
+        chat_id,
+        max_length=3000,
+        sample_rate=1.0,
+        max_queue=1000,
+        flush_interval=2,
+    ):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.max_length = max_length
+        self.sample_rate = sample_rate
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.sent = 0
+        self.sampled_out = 0
+        self.dropped = 0
+        self.failed = 0
+        self._thread = threading.Thread(target=self.run, name="bin", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def put(self, obj):
+        """
+        Queue an object to be mirrored, never blocks
+        A future is mirrored with its result once it is done
+        """
+        if hasattr(obj, "add_done_callback"):
+            obj.add_done_callback(self._put_result)
+            return
+        if random.random() >= self.sample_rate:
+            self.sampled_out = self.sampled_out + 1
+            return
+        try:
+            self.queue.put_nowait(obj)
+        except queue.Full:
+            self.dropped = self.dropped + 1
+
+    def _put_result(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self.put(future.result())
+
+    def run(self):
+        while True:
+            events = [serialize(self.queue.get())]
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    events.append(serialize(self.queue.get(timeout=remaining)))
+                except queue.Empty:
+                    break
+
+            for text in pack(events, self.max_length):
+                try:
+                    self.bot.send_message(chat_id=self.chat_id, text=text)
+                    self.sent = self.sent + 1
+                except Exception as e:
+                    self.failed = self.failed + 1
+                    logging.error(f"BIN Fail : {e}")
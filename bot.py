@@ -1,12 +1,29 @@
 import telegram
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.error import NetworkError, Unauthorized
-from google_sheet_to_json import fetch
-from analytics import Analytics
+from google_sheet_to_json import fetch_delta, remember
+from analytics import AnalyticsWriter
+from snapshot import SnapshotStore, BED_COLS, changed_hospitals
+from refresher import Refresher
+from cache import ReplyCache
+from dispatcher import Dispatcher
+from bin_mirror import BinMirror
+from state import StateStore
+from snapshot_file import save_snapshot, load_snapshot
+from search import normalize
+from geo import CENTROIDS
+from webhook import WebhookServer
+from outbox import Outbox, USER, CHANNEL, BIN
+from subscriptions import Subscriptions, reshard, shard_path
+import metrics
+from metrics import SlowProfiler
+import concurrent.futures
+import contextvars
 import json
 import os
-import ast
+import secrets
 from time import sleep
+from functools import partial
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
@@ -22,15 +39,105 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 
-DATA_UPDATE_MIN = 1
+DATA_UPDATE_MIN = float(os.environ.get("DATA_UPDATE_MIN", 1))
+# Replies say the data is stale once it is older than this
+STALE_AFTER_MIN = 5
 SCHEDULE_MSG_MIN = 60
+# Post only the hospitals that changed since the last scheduled message
+BROADCAST_CHANGES_ONLY = os.environ.get("BROADCAST_CHANGES_ONLY", "") == "1"
+# Telegram's limit on the length of a message
+MAX_MESSAGE_LENGTH = 4096
+N_WORKERS = int(os.environ.get("N_WORKERS", 4))
+MAX_PENDING_UPDATES = 100
 SCHEDULE_CHANNEL = os.environ["SCHEDULE_CHANNEL"]
+# Point at a local Bot API server or a stand-in
+API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org/bot")
 try:
     BIN_CHANNEL = os.environ["BIN_CHANNEL"]
 except:
     BIN_CHANNEL = None
     logging.warning("No Bin. Won't Bin")
+# Most hospitals a name search replies with
+HOSPITAL_MATCHES = 5
+# Nearest hospitals /near replies with, and how far it looks
+NEAR_MATCHES = 5
+NEAR_MAX_KM = 25
+# Bed types as they can be typed after /near
+NEAR_BEDTYPES = {
+    "general": "general",
+    "hdu": "hdu",
+    "icu": "icu",
+    "ventilator": "icuwithventilator",
+    "v-icu": "icuwithventilator",
+}
+# Set to have Telegram push updates to this HTTPS URL instead of polling
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+# Where the webhook server listens, usually behind a TLS terminating proxy
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8080))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_MAX_CONNECTIONS = 40
 BIN_MAX_LENGTH = 3000
+BIN_SAMPLE_RATE = float(os.environ.get("BIN_SAMPLE_RATE", 1))
+# Prometheus metrics on localhost, 0 turns the endpoint off
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9108))
+# Log where the time went in updates slower than this, 0 turns it off
+PROFILE_SLOW_MS = float(os.environ.get("PROFILE_SLOW_MS", 0))
+# Set up in main() when there is a BIN_CHANNEL
+MIRROR = None
+# Rate limited sending, set up in main()
+OUTBOX = None
+# Sent instead of a reply that Telegram refused
+SEND_FAILED_TEXT = "Hospital fetch failed"
+N_SENDERS = 8
+# Sends started while handling the current update
+PENDING_SENDS = contextvars.ContextVar("pending_sends", default=None)
+# Messages a second across all chats, Telegram allows about 30
+SEND_RATE = float(os.environ.get("SEND_RATE", 30))
+
+# Subscriptions a chat can have, and most hospitals in one notification
+MAX_SUBSCRIPTIONS = 10
+NOTIFY_MAX_HOSPITALS = 10
+
+# Column types of the cleaned data
+# Timestamps as the sheet writes them, e.g. 4/10/2021 8:06:00
+TIMESTAMP_FORMAT = "%m/%d/%Y %H:%M:%S"
+BED_DTYPE = "int16"
+CATEGORY_COLS = ["hospital", "zone", "pincode", "type"]
+
+# Last published data, for a fast cold start
+SNAPSHOT_FILE = "snapshot.bin"
+SUBSCRIPTIONS_FILE = "subscriptions.json"
+
+# Current cleaned data, shared by every query
+STORE = SnapshotStore()
+# Rendered replies of the current data version
+REPLY_CACHE = ReplyCache(maxsize=256)
+# Chats to tell when beds change in a zone, pincode or bed type
+SUBSCRIPTIONS = Subscriptions(SUBSCRIPTIONS_FILE, max_per_chat=MAX_SUBSCRIPTIONS)
+# Bot state, loaded from metadata.json once at startup and written behind
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S%z"
+TIME_START = "1900-01-01 00:00:00+05:30"
+UPDATES = metrics.counter("hf_updates_total", "Updates handled")
+UPDATE_SECONDS = metrics.histogram("hf_update_seconds", "Time to handle an update")
+FETCH_FAILURES = metrics.counter("hf_fetch_failures_total", "Sheet fetches that failed")
+BAD_TIMESTAMPS = metrics.counter(
+    "hf_bad_timestamps_total", "Rows whose timestamp couldn't be read"
+)
+PROFILER = SlowProfiler(PROFILE_SLOW_MS / 1000) if PROFILE_SLOW_MS else None
+STATE = StateStore(
+    "metadata.json",
+    defaults={
+        "last_updated_time": TIME_START,
+        "scheduled_sent_time": TIME_START,
+        # Beds of every hospital as of the last scheduled message
+        "broadcast_beds": None,
+        "zones": [],
+        "pincodes": [],
+        "offset": 0,
+        "done": [],
+    },
+)
 
 
 def clean_data(data):
@@ -51,273 +158,454 @@ def clean_data(data):
         "timestamp",
         "type",
         "interested",
+        "rowid",
     ]
     col_maps = {
         "hospitalname": "hospital",
         "contactno": "phonenumber",
         "icu-v": "icuwithventilator",
     }
-    int_cols = ["general", "hdu", "icu", "icuwithventilator", "timestamp"]
+    bed_cols = ["general", "hdu", "icu", "icuwithventilator"]
+
+    if data.empty:
+        data = pd.DataFrame(columns=sel_cols)
+    # Output files written before rows had ids
+    if "rowid" not in data.columns:
+        data["rowid"] = data.index.astype(str)
 
     data = data[sel_cols]
     data.rename(columns=col_maps, inplace=True)
-    data[int_cols] = data[int_cols].apply(lambda x: x.replace("-", "0"))
     # Interest condition
     data = data[data["interested"].str.contains("Yes")]
     # Type condition
     data = data[(data["type"] == "Covid") | (data["type"] == "Both")]
-
+    data = data.drop(columns="interested")
+
+    # Bed counts as small integers, "-" and blanks are 0
+    for col in bed_cols:
+        data[col] = (
+            pd.to_numeric(data[col], errors="coerce").fillna(0).astype(BED_DTYPE)
+        )
+    # Always the sheet's format, never inferred from the first row of a batch
+    raw = data["timestamp"]
+    data["timestamp"] = pd.to_datetime(raw, format=TIMESTAMP_FORMAT, errors="coerce")
+    bad = data["timestamp"].isna() & (raw.astype(str).str.strip() != "")
+    if bad.any():
+        BAD_TIMESTAMPS.inc(int(bad.sum()))
+        logging.warning(
+            f"{int(bad.sum())} row(s) with unreadable timestamps, "
+            f"e.g. {raw[bad].iloc[0]!r}"
+        )
+
+    return as_categories(data)
+
+
+def as_categories(data):
+    """
+    Store the repetitive text columns as categorical codes
+    """
+    for col in CATEGORY_COLS:
+        data[col] = data[col].astype(str).astype("category")
     return data
 
 
-def read_status_logs():
+def state_time(key):
     """
-    Check metadata file to check the freshness
-    If the freshness is less than a minute, fetch the data again
-
+    Read a time from the bot state
     """
     try:
-        with open("metadata.json", "r") as f:
-            meta = json.load(f)
-            last_updated_time = datetime.strptime(
-                meta["last_updated_time"], "%Y-%m-%d %H:%M:%S%z"
-            )
+        return datetime.strptime(STATE.get(key), TIME_FORMAT)
+    except (TypeError, ValueError):
+        return datetime.strptime(TIME_START, TIME_FORMAT)
+
 
+def refresh_data():
+    """
+    Fetch the changes in the sheet and apply them
+    Returns True if the sheet could be read
+    """
+    fetch_start_time = datetime.now(IST)
+    try:
+        with metrics.timed("fetch"):
+            delta, state = fetch_delta()
     except Exception as e:
         logging.error(e)
-        logging.info("Will create a new metadata file")
-        meta = {}
-        TIME_START = "1900-01-01 00:00:00+05:30"
-        meta["scheduled_sent_time"] = meta["last_updated_time"] = TIME_START
-        last_updated_time = datetime.strptime(TIME_START, "%Y-%m-%d %H:%M:%S%z")
-
-    if (datetime.now(IST) - last_updated_time) > timedelta(minutes=DATA_UPDATE_MIN):
-        fetch_start_time = datetime.now(IST).strftime("%Y-%m-%d %H:%M:%S%z")
-        try:
-            newData = fetch()
-            logging.info("Data refreshed")
-        except Exception as e:
-            logging.error(e)
-            return None
-        with open("metadata.json", "w") as f:
-            nD = pd.DataFrame(newData)
-            meta.update(
-                {
-                    "last_updated_time": fetch_start_time,
-                    "zones": sorted([z for z in list(nD["zone"].unique()) if z != ""]),
-                    "pincodes": sorted(
-                        [z for z in list(nD["pincode"].unique()) if z != ""]
-                    ),
-                }
-            )
-            json.dump(meta, f, indent=4)
+        FETCH_FAILURES.inc()
+        return False
+    apply_delta(delta, fetch_start_time)
+    remember(state)
+    return True
+
+
+def apply_delta(delta, fetch_start_time):
+    """
+    Merge the changed rows into the current table
+    and publish the result as a new snapshot
+    Record the refresh time, zones and pincodes in the bot state
+    once the data is published
+    """
+    if delta is None:
+        logging.info("No changes in the data")
+        STORE.touch(fetch_start_time)
+        STATE.update(last_updated_time=fetch_start_time.strftime(TIME_FORMAT))
+        return
+
+    # Only the changed rows are cleaned
+    with metrics.timed("clean_data"):
+        changed = clean_data(delta["upserts"])
+    current = STORE.get().status
+    if delta["full"] or current is None:
+        status = changed
+    else:
+        stale_ids = set(delta["removed"]) | set(delta["upserts"]["rowid"])
+        status = current[~current["rowid"].isin(stale_ids)]
+        status = as_categories(pd.concat([status, changed], ignore_index=True))
+    with metrics.timed("publish"):
+        snapshot = STORE.publish(status, fetch_start_time)
+    try:
+        save_snapshot(snapshot, SNAPSHOT_FILE)
+    except Exception as e:
+        logging.error(f"Couldn't save the snapshot : {e}")
+    logging.info(
+        f"Data refreshed : {len(delta['upserts']['rowid'])} row(s) changed, "
+        f"{len(delta['removed'])} removed"
+    )
+
+    STATE.update(
+        last_updated_time=fetch_start_time.strftime(TIME_FORMAT),
+        zones=sorted([z for z in status["zone"].unique() if z != ""]),
+        pincodes=sorted([z for z in status["pincode"].unique() if z != ""]),
+    )
+
 
+def load_status_logs():
+    """
+    Publish the last saved snapshot so that queries can be served
+    on a cold start before the first refresh completes
+    Falls back to the last `output.json`
+    """
+    saved = load_snapshot(SNAPSHOT_FILE, columns=clean_data([]).columns)
+    if saved is not None:
+        status, version, updated_time = saved
+        return STORE.publish(status, updated_time, version)
+
+    last_updated_time = state_time("last_updated_time")
     try:
         with open("output.json", "r") as f:
             status = json.load(f)
             status = pd.DataFrame(status)
             # Clean
             status = clean_data(status)
-        return status
     except FileNotFoundError:
-        logging.info("Output file does not exist and couldn't be fetched!")
+        logging.info("Output file does not exist yet")
         return None
+    return STORE.publish(status, last_updated_time)
 
 
-def hosps_in_pincode(status, pincode):
+def hosps_in_pincode(snapshot, pincode):
     """
-    Return the data of all hospitals in a pincode
+    Return all hospitals in a pincode
     Also returns the count of hospitals
     """
     pincode = str(pincode)
-    sel_status = status[status["pincode"] == pincode]
+    hosps = snapshot.by_pincode.get(pincode, [])
 
-    try:
-        hosp_count = sel_status.hospital.nunique()
-    except KeyError:
-        hosp_count = 0
+    return hosps, len(hosps)
+
+
+def hosps_in_zone(snapshot, zone):
+    """
+    Return all hospitals in a zone
+    Also returns the count of hospitals
+    """
+    hosps = snapshot.by_zone.get(zone, [])
 
-    return sel_status, hosp_count
+    return hosps, len(hosps)
 
 
-def hosps_in_zone(status, zone):
+def hosps_by_name(snapshot, name):
     """
-    Return the data of all hospitals in a pincode
+    Return the hospitals with names most like `name`, best match first
     Also returns the count of hospitals
     """
-    sel_status = status[status["zone"] == zone]
+    hosps = [hosp for hosp, _ in snapshot.by_name.search(name, HOSPITAL_MATCHES)]
 
-    try:
-        hosp_count = sel_status.hospital.nunique()
-    except KeyError:
-        hosp_count = 0
-    return sel_status, hosp_count
+    return hosps, len(hosps)
+
+
+def hosps_near(snapshot, pincode, bedtype="any"):
+    """
+    Return the hospitals nearest to a pincode with available beds
+    of `bedtype`, closest first, with their distance in km
+    Returns None if the location of the pincode isn't known
+    """
+    location = CENTROIDS.get(str(pincode))
+    if location is None:
+        return None
+    available = snapshot.has_beds[bedtype]
+    return snapshot.by_location.nearest(
+        *location, k=NEAR_MATCHES, accept=available.__contains__, max_km=NEAR_MAX_KM
+    )
 
 
-def hosps_in_bedtype(status, bedtype):
+def hosps_in_bedtype(snapshot, bedtype):
     """
-    Return the data of all hospitals that has available
+    Return all hospitals that have available
     beds in the provided bedtype
     Also returns the count of hospitals
     """
-    sel_status = status[(pd.to_numeric(status[bedtype]) > 0)]
+    hosps = snapshot.by_bedtype[bedtype]
+
+    return hosps, len(hosps)
+
+
+def format_timestamp(ts):
+    """
+    Timestamp as shown in messages
+    """
+    if pd.isna(ts):
+        return "-"
+    return ts.strftime("%d-%m-%Y %H:%M:%S")
 
-    try:
-        hosp_count = sel_status.hospital.nunique()
-    except KeyError:
-        hosp_count = 0
-    return sel_status, hosp_count
-
-
-def get_latest(s, n_latest=1):
-    """
-    For each hospital, get the `n_latest` status logs
-    """
-    s.sort_values("timestamp", ascending=False, inplace=True)
-    result = (
-        s[
-            [
-                "timestamp",
-                "general",
-                "hdu",
-                "icu",
-                "icuwithventilator",
-                "phonenumber",
-                "remarks",
-            ]
-        ]
-        .head(n_latest)
-        .to_dict("records")
-    )
 
-    return result
+def format_header(header):
+    return "*" + header + "*\n" + "=" * len(header)
+
+
+def format_hospital(r):
+    """
+    The formatted status of one hospital
+    Empty if none of its logs have a bed available
+    """
+    status_parts = []
+    for l in r["logs"]:
+        if l["general"] + l["hdu"] + l["icu"] + l["icuwithventilator"] <= 0:
+            continue
+        status_parts.append(
+            "```\n"
+            f"Last updated: {format_timestamp(l['timestamp'])} \n"
+            f"GEN: {l['general']} | "
+            f"HDU: {l['hdu']} | "
+            f"ICU: {l['icu']} | "
+            f"V-ICU: {l['icuwithventilator']}"
+            "\n```"
+        )
+    if not status_parts:
+        return ""
+    if r["logs"][0]["phonenumber"] != "":
+        phn_num = f"+91{r['logs'][0]['phonenumber']}"
+    else:
+        phn_num = ""
+    return "".join([f"\n*{r['hospital']}*\n📞 {phn_num}\n", *status_parts, "\n"])
 
 
 def prepare_message(logs, header=""):
     """
     Prepare the formatted message
     """
-    avl_ctr = 0
-    message = "*" + header + "*\n" + "=" * len(header)
+    parts = [format_header(header)]
     for r in logs:
-        status_msg = ""
-        for l in r["logs"]:
-            if (
-                int(l["general"])
-                + int(l["hdu"])
-                + int(l["icu"])
-                + int(l["icuwithventilator"])
-            ) <= 0:
-                continue
-            status_msg = (
-                status_msg
-                + "```\n"
-                + f"Last updated: {l['timestamp']} \n"
-                + f"GEN: {l['general']} | "
-                + f"HDU: {l['hdu']} | "
-                + f"ICU: {l['icu']} | "
-                + f"V-ICU: {l['icuwithventilator']}"
-                + "\n```"
-            )
-        if status_msg != "":
-            avl_ctr = avl_ctr + 1
-            if r["logs"][0]["phonenumber"] != "":
-                phn_num = f"+91{r['logs'][0]['phonenumber']}"
-            else:
-                phn_num = ""
-            message = (
-                message
-                + "\n*"
-                + r["hospital"]
-                + "*\n"
-                + "📞 "
-                + phn_num
-                + "\n"
-                + status_msg
-                + "\n"
-            )
+        parts.append(format_hospital(r))
 
-    if avl_ctr == 0:
-        message = message + f"\nNo beds available in {len(logs)} tracked hospital(s)"
-    return message
+    if not any(parts[1:]):
+        parts.append(f"\nNo beds available in {len(logs)} tracked hospital(s)")
+    return "".join(parts)
 
 
-def prepare_scheduled_message():
+def message_length(text):
     """
-    Prepare the message to be sent to the channel
+    Length as Telegram counts it, in UTF-16 code units
     """
+    return len(text.encode("utf-16-le")) // 2
 
-    status = read_status_logs()
-    grp = status.groupby("hospital")
-    logs = []
-    for hosp, s in grp:
-        logs.append({"hospital": hosp, "logs": get_latest(s, n_latest=1)})
-    time_now = datetime.now(IST).strftime("%Y-%m-%d  %H:%M")
-    header = f"*Status @ : {time_now}* \n"
-    message = prepare_message(logs, header)
-    _footer = "\nBot Link : @citagbedinfoline\_bot\n"
-    message = message + _footer
 
-    return message
+def split_message(header, blocks, footer="", max_length=MAX_MESSAGE_LENGTH):
+    """
+    Pack the blocks, in order, into messages of at most `max_length`
+    Every message starts with the header, numbered when there are several,
+    and the last one ends with the footer
+    A block is never split, so its markdown stays balanced
+    """
+    # Room left for blocks with the longest numbered header
+    room = (
+        max_length
+        - message_length(format_header(f"{header} (99/99)"))
+        - message_length(footer)
+    )
+    chunks = [[]]
+    size = 0
+    for block in blocks:
+        length = message_length(block)
+        if chunks[-1] and size + length > room:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(block)
+        size = size + length
+    messages = []
+    for i, chunk in enumerate(chunks):
+        title = header if len(chunks) == 1 else f"{header} ({i + 1}/{len(chunks)})"
+        messages.append(format_header(title) + "".join(chunk))
+    messages[-1] = messages[-1] + footer
+    return messages
+
+
+def data_age():
+    """
+    Time since the data served was read from the sheet, None before it is
+    """
+    updated_time = STORE.get().updated_time
+    if updated_time is None:
+        return None
+    return datetime.now(IST) - updated_time
 
 
-def send_to_channel(bot):
+def stale_note():
     """
-    Send the scheduled message to channel
+    A note for replies served while the sheet can't be refreshed
+    Empty while the data is fresh
     """
-    message = prepare_scheduled_message()
-    send_message(
-        bot=bot,
-        chat_id=SCHEDULE_CHANNEL,
-        text=message,
-        parse_mode=telegram.ParseMode.MARKDOWN,
-    )
+    age = data_age()
+    if age is None or age <= timedelta(minutes=STALE_AFTER_MIN):
+        return ""
+    minutes = int(age.total_seconds() // 60)
+    return f"\n_Data as of {minutes} min ago, the sheet can't be reached right now_\n"
 
 
-def process_pincode(pincode, n_latest=1):
+def bed_counts(latest):
     """
-    Return the data of all hospitals in a pincode
-    Format the response string
+    Map of hospital to its latest [general, hdu, icu, icuwithventilator] beds
     """
+    return {
+        hosp: [int(logs[0][bed]) for bed in BED_COLS] for hosp, logs in latest.items()
+    }
 
-    status = read_status_logs()
 
-    sel_status, hosp_count = hosps_in_pincode(status, pincode)
+def prepare_scheduled_messages(last_counts=None, changes_only=False):
+    """
+    Prepare the messages to be sent to the channel
+    With `changes_only`, only the hospitals whose beds differ
+    from `last_counts` are listed
+    Returns the messages and the bed counts they show,
+    no messages if nothing changed since `last_counts`
+    """
+    snapshot = STORE.get()
+    if snapshot.status is None:
+        return None, None
+    latest = snapshot.latest_logs(n_latest=1)
+    counts = bed_counts(latest)
+    if counts == last_counts:
+        return [], counts
+
+    blocks = []
+    if changes_only and last_counts:
+        hosps = [h for h in sorted(counts) if counts[h] != last_counts.get(h)]
+        for hosp in hosps:
+            blocks.append(
+                format_hospital({"hospital": hosp, "logs": latest[hosp]})
+                or f"\n*{hosp}*\nNo beds available now\n"
+            )
+        if not blocks:
+            # Only hospitals that left the sheet
+            return [], counts
+        title = "Changes @ :"
+    else:
+        for hosp in sorted(latest):
+            blocks.append(format_hospital({"hospital": hosp, "logs": latest[hosp]}))
+        blocks = [block for block in blocks if block]
+        if not blocks:
+            blocks.append(f"\nNo beds available in {len(latest)} tracked hospital(s)")
+        title = "Status @ :"
+    time_now = datetime.now(IST).strftime("%Y-%m-%d  %H:%M")
+    _footer = "\nBot Link : @citagbedinfoline\_bot\n"
+    messages = split_message(f"{title} {time_now}", blocks, stale_note() + _footer)
+    return messages, counts
+
 
-    grp = sel_status.groupby("hospital")
-    logs = []
-    for hosp, s in grp:
-        logs.append({"hospital": hosp, "logs": get_latest(s, n_latest=1)})
+def send_to_channel(bot):
+    """
+    Send the scheduled messages to channel
+    Skipped when no hospital's beds changed since the last one
+    Returns True if anything was sent
+    """
+    messages, counts = prepare_scheduled_messages(
+        STATE.get("broadcast_beds"), changes_only=BROADCAST_CHANGES_ONLY
+    )
+    if messages is None:
+        logging.warning("No data to send to the channel")
+        return False
+    if not messages:
+        logging.info("No changes since the last scheduled message, skipped")
+        STATE.update(broadcast_beds=counts)
+        return False
+    for message in messages:
+        send_message(
+            bot=bot,
+            chat_id=SCHEDULE_CHANNEL,
+            text=message,
+            parse_mode=telegram.ParseMode.MARKDOWN,
+        )
+    STATE.update(broadcast_beds=counts)
+    return True
+
+
+def reply_with_logs(
+    key, find, header, n_latest=1, label=None, none_found="No hospitals found"
+):
+    """
+    Format the latest logs of the hospitals `find(snapshot)` returns
+    `label` gives the name a hospital is shown with, its own by default
+    The message is cached under `key` for the data version
+    """
+    snapshot = STORE.get()
+    message = REPLY_CACHE.get(key, snapshot.version)
+    if message is not None:
+        return message + stale_note()
+
+    hosps = find(snapshot)
+
+    with metrics.timed("latest"):
+        latest = snapshot.latest_logs(n_latest)
+    logs = [
+        {"hospital": label(hosp) if label else hosp, "logs": latest[hosp]}
+        for hosp in hosps
+    ]
 
     if len(logs) == 0:
-        message = "No hospitals found"
+        message = none_found
     else:
-        message = prepare_message(logs, header=pincode)
-    return message
+        with metrics.timed("prepare_message"):
+            message = prepare_message(logs, header=header)
+    REPLY_CACHE.put(key, snapshot.version, message)
+    return message + stale_note()
 
 
-def process_zone(zone, n_latest=1):
+def process_pincode(pincode, n_latest=1):
     """
-    Return the data of all hospitals in a zone
+    Return the data of all hospitals in a pincode
     Format the response string
     """
-    status = read_status_logs()
-
-    sel_status, hosp_count = hosps_in_zone(status, zone)
+    return reply_with_logs(
+        ("pincode", pincode, n_latest),
+        lambda snapshot: hosps_in_pincode(snapshot, pincode)[0],
+        header=pincode,
+        n_latest=n_latest,
+    )
 
-    grp = sel_status.groupby("hospital")
-    logs = []
-    for hosp, s in grp:
-        logs.append({"hospital": hosp, "logs": get_latest(s, n_latest=1)})
 
-    if len(logs) == 0:
-        message = "No hospitals found"
-    else:
-        message = prepare_message(logs, header=zone)
-    return message
+def process_zone(zone, n_latest=1):
+    """
+    Return the data of all hospitals in a zone
+    Format the response string
+    """
+    return reply_with_logs(
+        ("zone", zone, n_latest),
+        lambda snapshot: hosps_in_zone(snapshot, zone)[0],
+        header=zone,
+        n_latest=n_latest,
+    )
 
 
-def process_bedtype(bedtype):
+def process_bedtype(bedtype, n_latest=1):
     """
     Return the data of all hospitals
     that have an available bed in the provided bedtype
@@ -331,20 +619,146 @@ def process_bedtype(bedtype):
 
     bedtype_mapped = bedtype_map[bedtype]
 
-    status = read_status_logs()
+    return reply_with_logs(
+        ("bedtype", bedtype, n_latest),
+        lambda snapshot: hosps_in_bedtype(snapshot, bedtype_mapped)[0],
+        header=bedtype,
+        n_latest=n_latest,
+    )
 
-    sel_status, hosp_count = hosps_in_bedtype(status, bedtype_mapped)
 
-    grp = sel_status.groupby("hospital")
-    logs = []
-    for hosp, s in grp:
-        logs.append({"hospital": hosp, "logs": get_latest(s, n_latest=1)})
+def process_hospital(name, n_latest=1):
+    """
+    Return the data of the hospitals matching a name
+    Format the response string
+    """
+    # Free text, kept to plain words so it is safe in the markdown header
+    name = normalize(name)
+    return reply_with_logs(
+        ("hospital", name, n_latest),
+        lambda snapshot: hosps_by_name(snapshot, name)[0],
+        header=name,
+        n_latest=n_latest,
+    )
+
+
+def process_near(pincode, bedtype="any", n_latest=1):
+    """
+    Return the data of the hospitals closest to a pincode
+    that have an available bed of `bedtype`
+    """
+    if str(pincode) not in CENTROIDS:
+        return f"Location of pincode {pincode} is not known" + stale_note()
+
+    # Closest first, as found in the snapshot the reply is made from
+    distances = {}
+
+    def find(snapshot):
+        distances.update(hosps_near(snapshot, pincode, bedtype))
+        return list(distances)
+
+    return reply_with_logs(
+        ("near", pincode, bedtype, n_latest),
+        find,
+        header=f"Near {pincode}",
+        n_latest=n_latest,
+        label=lambda hosp: f"{hosp} ({distances[hosp]:.1f} km)",
+        none_found=f"No hospitals with beds found within {NEAR_MAX_KM} km",
+    )
 
-    if len(logs) == 0:
-        message = "No hospitals found"
-    else:
-        message = prepare_message(logs, header=bedtype)
-    return message
+
+def parse_topic(text):
+    """
+    The (kind, value) subscription topic of a zone, pincode or bed type
+    as typed after /subscribe, None if it is none of those
+    """
+    text = text.strip()
+    if text.isdigit() and len(text) == 6:
+        return "pincode", text
+    if text.lower() in NEAR_BEDTYPES:
+        return "bedtype", NEAR_BEDTYPES[text.lower()]
+    for zone in STATE.get("zones"):
+        if zone.lower() == text.lower():
+            return "zone", zone
+    return None
+
+
+def prepare_change_message(snapshot, hosps):
+    """
+    Prepare the message telling a subscriber of the hospitals whose beds changed
+    """
+    latest = snapshot.latest_logs(n_latest=1)
+    logs = [
+        {"hospital": hosp, "logs": latest[hosp]}
+        for hosp in hosps[:NOTIFY_MAX_HOSPITALS]
+    ]
+    message = prepare_message(logs, header="Beds changed")
+    if len(hosps) > NOTIFY_MAX_HOSPITALS:
+        message = message + f"\n_and {len(hosps) - NOTIFY_MAX_HOSPITALS} more_\n"
+    return message + "\n_Send /unsubscribe to stop these messages_"
+
+
+def notify_subscribers(bot, old, new):
+    """
+    Tell subscribers of the hospitals whose latest beds changed
+    Only the chats subscribed to the zone, pincode or bed type of
+    a changed hospital are looked up, so the work grows with the change
+    Bed type subscribers only hear of beds of that type becoming available
+    """
+    if not len(SUBSCRIPTIONS):
+        return
+    changed = changed_hospitals(old, new)
+    if not changed:
+        return
+    latest = new.latest_logs(n_latest=1)
+    hosps_by_chat = {}
+    for hosp, beds in changed.items():
+        topics = [
+            ("zone", new.zone_of.get(hosp)),
+            ("pincode", new.pincode_of.get(hosp)),
+        ]
+        topics.extend(("bedtype", bed) for bed in beds if latest[hosp][0][bed] > 0)
+        for topic in topics:
+            for chat_id in SUBSCRIPTIONS.chats(topic):
+                hosps_by_chat.setdefault(chat_id, set()).add(hosp)
+
+    # Chats with the same subscriptions get the same message
+    messages = {}
+    for chat_id, hosps in hosps_by_chat.items():
+        hosps = tuple(sorted(hosps))
+        if hosps not in messages:
+            messages[hosps] = prepare_change_message(new, hosps)
+        try:
+            msg = send_message(
+                bot=bot,
+                chat_id=chat_id,
+                text=messages[hosps],
+                fallback=None,
+                parse_mode=telegram.ParseMode.MARKDOWN,
+            )
+        except Unauthorized:
+            forget_blocked(chat_id)
+            continue
+        except Exception as e:
+            logging.error(f"Couldn't notify {chat_id} : {e}")
+            continue
+        if hasattr(msg, "add_done_callback"):
+            msg.add_done_callback(partial(forget_blocked, chat_id))
+    logging.info(
+        f"{len(changed)} hospital(s) changed, notified {len(hosps_by_chat)} chat(s)"
+    )
+
+
+def forget_blocked(chat_id, future=None):
+    """
+    Drop the subscriptions of a chat that blocked the bot
+    With a `future`, only if sending to the chat failed for that
+    """
+    if future is not None:
+        if future.cancelled() or not isinstance(future.exception(), Unauthorized):
+            return
+    logging.info(f"Chat {chat_id} blocked the bot, dropping its subscriptions")
+    SUBSCRIPTIONS.unsubscribe(chat_id)
 
 
 def build_menu(buttons, n_cols, header_buttons=None, footer_buttons=None):
@@ -359,21 +773,59 @@ def build_menu(buttons, n_cols, header_buttons=None, footer_buttons=None):
     return menu
 
 
-def send_message(bot, chat_id, text, **kwargs):
+def send_message(bot, chat_id, text, fallback=SEND_FAILED_TEXT, **kwargs):
     """
     Custom send_message with BIN
+    Goes through the outbox when there is one, channel messages after replies
+    If a queued reply to a user fails, e.g. on bad markdown, the user
+    is sent the plain `fallback` instead
+    Returns the sent message, or its future when queued
     """
-    msg = bot.send_message(chat_id=chat_id, text=text, **kwargs)
-    msg = str(msg)
+    if OUTBOX:
+        if chat_id == SCHEDULE_CHANNEL:
+            lane = CHANNEL
+        elif chat_id == BIN_CHANNEL:
+            lane = BIN
+        else:
+            lane = USER
+        msg = OUTBOX.send(chat_id, text, lane=lane, **kwargs)
+        send = partial(OUTBOX.send, chat_id, lane=USER)
+    else:
+        with metrics.timed("send_message"):
+            msg = bot.send_message(chat_id=chat_id, text=text, **kwargs)
+        send = partial(bot.send_message, chat_id)
+    # The outbox and the asyncio client return a future of the message
+    if hasattr(msg, "add_done_callback"):
+        sent = msg
+        if fallback and chat_id not in (SCHEDULE_CHANNEL, BIN_CHANNEL):
+            # Done once the reply, or the fallback in its place, is sent
+            sent = concurrent.futures.Future()
+            msg.add_done_callback(partial(send_fallback, send, fallback, sent))
+        pending = PENDING_SENDS.get()
+        if pending is not None:
+            pending.append(sent)
     # BIN IF BIN
-    if BIN_CHANNEL:
-        try:
-            bot.send_message(
-                chat_id=BIN_CHANNEL, text=json.dumps(ast.literal_eval(msg), indent=4)
-            )
-        except Exception as e:
-            logging.error(f"BIN Fail : {e}")
-            pass
+    if MIRROR:
+        MIRROR.put(msg)
+    return msg
+
+
+def send_fallback(send, text, sent, future):
+    """
+    Send `text` as plain text with `send` if the message in `future`
+    could not be sent, `sent` is done once that is settled
+    """
+    error = None if future.cancelled() else future.exception()
+    # Nothing gets through to a chat that blocked the bot
+    if error is None or isinstance(error, Unauthorized):
+        sent.set_result(None)
+        return
+    try:
+        fallback = send(text)
+    except Exception:
+        sent.set_result(None)
+        raise
+    fallback.add_done_callback(lambda _: sent.set_result(None))
 
 
 def entry(bot, update):
@@ -381,15 +833,8 @@ def entry(bot, update):
     Handle all actions by the bot
     """
     # BIN IF BIN
-    if BIN_CHANNEL:
-        try:
-            msg = str(update)
-            bot.send_message(
-                chat_id=BIN_CHANNEL, text=json.dumps(ast.literal_eval(msg), indent=4)
-            )
-        except Exception as e:
-            logging.error(f"BIN Fail : {e}")
-            pass
+    if MIRROR:
+        MIRROR.put(update)
 
     # CALLBACKS
     if update.callback_query:
@@ -459,10 +904,8 @@ def entry(bot, update):
     if update.message:
 
         # Load the zones and pincodes
-        with open("metadata.json", "r") as f:
-            meta = json.load(f)
-        zones = meta["zones"]
-        pincodes = meta["pincodes"]
+        zones = STATE.get("zones")
+        pincodes = STATE.get("pincodes")
         # ZONE
         try:
             if update.message.text.startswith("/zone"):
@@ -543,13 +986,130 @@ def entry(bot, update):
             )
             return
 
-        # TODO : FUZZY MATCH ON HOSPITAL NAMES
+        # HOSPITAL
+        try:
+            if update.message.text.startswith("/hospital"):
+                name = update.message.text[len("/hospital") :].strip()
+                if not name:
+                    send_message(
+                        bot=bot,
+                        chat_id=update.message.chat.id,
+                        text="Send the name after the command, like `/hospital victoria`",
+                        parse_mode=telegram.ParseMode.MARKDOWN,
+                    )
+                    return
+                bot.send_chat_action(
+                    chat_id=update.message.chat.id, action=telegram.ChatAction.TYPING
+                )
+                message = process_hospital(name)
+                send_message(
+                    bot=bot,
+                    chat_id=update.message.chat.id,
+                    text=message,
+                    parse_mode=telegram.ParseMode.MARKDOWN,
+                )
+                return
+        except Exception as e:
+            logging.error(e)
+            send_message(
+                bot=bot, chat_id=update.message.chat.id, text="Hospital fetch failed"
+            )
+            return
+
+        # NEAR
+        try:
+            if update.message.text.startswith("/near"):
+                args = update.message.text.split()[1:]
+                pincode = args[0] if args else ""
+                bedtype = args[1].lower() if len(args) > 1 else None
+                if not (pincode.isdigit() and len(pincode) == 6) or (
+                    bedtype is not None and bedtype not in NEAR_BEDTYPES
+                ):
+                    send_message(
+                        bot=bot,
+                        chat_id=update.message.chat.id,
+                        text="Send a pincode and optionally a bed type, "
+                        "like `/near 560034 icu`\n"
+                        f"Bed types : {', '.join(NEAR_BEDTYPES)}",
+                        parse_mode=telegram.ParseMode.MARKDOWN,
+                    )
+                    return
+                bot.send_chat_action(
+                    chat_id=update.message.chat.id, action=telegram.ChatAction.TYPING
+                )
+                message = process_near(pincode, NEAR_BEDTYPES.get(bedtype, "any"))
+                send_message(
+                    bot=bot,
+                    chat_id=update.message.chat.id,
+                    text=message,
+                    parse_mode=telegram.ParseMode.MARKDOWN,
+                )
+                return
+        except Exception as e:
+            logging.error(e)
+            send_message(
+                bot=bot, chat_id=update.message.chat.id, text="Hospital fetch failed"
+            )
+            return
 
-        # TODO : NEARBY PINCODES
+        # SUBSCRIBE
+        try:
+            if update.message.text.startswith("/subscribe"):
+                chat_id = update.message.chat.id
+                text = update.message.text[len("/subscribe") :].strip()
+                topic = parse_topic(text) if text else None
+                if topic is None:
+                    topics = SUBSCRIPTIONS.topics(chat_id)
+                    current = ", ".join(value for _, value in topics) or "none"
+                    message = (
+                        "Send a zone, pincode or bed type after the command, "
+                        "like `/subscribe 560034`\n"
+                        f"Bed types : {', '.join(NEAR_BEDTYPES)}\n"
+                        f"Subscribed to : {current}"
+                    )
+                elif not SUBSCRIPTIONS.subscribe(chat_id, *topic):
+                    message = (
+                        f"You can subscribe to at most {MAX_SUBSCRIPTIONS}, "
+                        "send /unsubscribe to drop them"
+                    )
+                else:
+                    message = f"You'll get a message when beds change in {topic[1]}"
+                send_message(
+                    bot=bot,
+                    chat_id=chat_id,
+                    text=message,
+                    parse_mode=telegram.ParseMode.MARKDOWN,
+                )
+                return
+            if update.message.text.startswith("/unsubscribe"):
+                chat_id = update.message.chat.id
+                text = update.message.text[len("/unsubscribe") :].strip()
+                if text:
+                    topic = parse_topic(text)
+                    dropped = SUBSCRIPTIONS.unsubscribe(chat_id, *topic) if topic else 0
+                else:
+                    dropped = SUBSCRIPTIONS.unsubscribe(chat_id)
+                send_message(
+                    bot=bot,
+                    chat_id=chat_id,
+                    text=f"Dropped {dropped} subscription(s)",
+                )
+                return
+        except Exception as e:
+            logging.error(e)
+            send_message(
+                bot=bot, chat_id=update.message.chat.id, text="Something wrong.. :/"
+            )
+            return
 
         # TEST
         if update.message.text.startswith("/test"):
-            update.message.reply_text("200 OK!", parse_mode=telegram.ParseMode.MARKDOWN)
+            send_message(
+                bot=bot,
+                chat_id=update.message.chat.id,
+                text="200 OK!",
+                parse_mode=telegram.ParseMode.MARKDOWN,
+            )
             return
 
         # START
@@ -569,14 +1129,210 @@ def entry(bot, update):
             - Send the keyword /bedtype
             - Choose a bedtype
             - Hospitals with the beds of bedtype chosen available is displayed
+            \n*Hospital*
+            - Send /hospital followed by a hospital name
+            - Hospitals with the closest names are listed, typos are fine
+            \n*Near*
+            - Send /near followed by a pincode, and a bed type if you need one
+            - The closest hospitals with available beds are listed
+            \n*Subscribe*
+            - Send /subscribe followed by a zone, pincode or bed type
+            - A message is sent whenever beds change there
+            - Send /unsubscribe to stop them
             \n\n_Send `/test` for checking if the bot is online_"""
 
-            update.message.reply_text(
-                str(help_text), parse_mode=telegram.ParseMode.MARKDOWN
+            send_message(
+                bot=bot,
+                chat_id=update.message.chat.id,
+                text=str(help_text),
+                parse_mode=telegram.ParseMode.MARKDOWN,
             )
             return
 
 
+def start_outbox(bot):
+    """
+    Start sending messages within Telegram's rate limits
+    """
+    global OUTBOX
+    OUTBOX = Outbox(bot, n_senders=N_SENDERS, rate=SEND_RATE)
+    OUTBOX.start()
+
+
+def start_mirror(bot):
+    """
+    Start mirroring updates and replies to the BIN channel, if there is one
+    Mirrored messages go through the outbox when there is one
+    """
+    global MIRROR
+    if BIN_CHANNEL:
+        MIRROR = BinMirror(
+            OUTBOX or bot,
+            BIN_CHANNEL,
+            max_length=BIN_MAX_LENGTH,
+            sample_rate=BIN_SAMPLE_RATE,
+        )
+        MIRROR.start()
+
+
+def log_usage(lytics, update):
+    """
+    Queue the update for the usage log
+    """
+    try:
+        timestamp = datetime.now(IST).strftime("%Y-%m-%d %H:%M:%S%z")
+        update_id = update.update_id + 1
+        try:
+            tg_id = update["message"]["chat"]["id"]
+        except TypeError:
+            tg_id = ""
+        try:
+            tg_username = update["message"]["chat"]["username"]
+        except TypeError:
+            tg_username = ""
+        try:
+            tg_firstname = update["message"]["chat"]["first_name"]
+        except TypeError:
+            tg_firstname = ""
+        try:
+            tg_lastname = update["message"]["chat"]["last_name"]
+        except TypeError:
+            tg_lastname = ""
+        try:
+            text = update["message"]["text"]
+        except TypeError:
+            text = ""
+
+        row = [
+            timestamp,
+            update_id,
+            tg_id,
+            tg_username,
+            tg_firstname,
+            tg_lastname,
+            text,
+        ]
+        logging.info(row)
+        lytics.put(row)
+    except Exception as e:
+        logging.error(f"Analytics post failed : {e}")
+
+
+def handle_update(bot, update):
+    """
+    Run `entry` on the update, timed and profiled if it is slow
+    """
+    UPDATES.inc()
+    with UPDATE_SECONDS.time():
+        if PROFILER:
+            with PROFILER.watch(f"Update {update.update_id + 1}"):
+                entry(bot, update)
+        else:
+            entry(bot, update)
+
+
+def start_subscriptions(bot, shard=None, n_shards=1):
+    """
+    Load the subscriptions and notify them after every data refresh
+    A worker process given a `shard` only has the chats of that shard
+    """
+    if shard is None:
+        reshard(SUBSCRIPTIONS_FILE, 1)
+    else:
+        SUBSCRIPTIONS.path = shard_path(SUBSCRIPTIONS_FILE, shard, n_shards)
+    SUBSCRIPTIONS.load()
+    STORE.add_listener(lambda old, new: notify_subscribers(bot, old, new))
+    metrics.gauge(
+        "hf_subscriptions", "Subscriptions to bed changes", lambda: len(SUBSCRIPTIONS)
+    )
+
+
+def start_metrics(pending=None, lytics=None):
+    """
+    Serve the metrics, with gauges read from the running parts of the bot
+    `pending` returns the number of updates being processed
+    """
+    if not METRICS_PORT:
+        return None
+
+    def data_age_seconds():
+        age = data_age()
+        return float("nan") if age is None else age.total_seconds()
+
+    metrics.gauge(
+        "hf_data_age_seconds", "Seconds since the sheet was last read", data_age_seconds
+    )
+    metrics.gauge(
+        "hf_snapshot_version", "Version of the data served", lambda: STORE.get().version
+    )
+    metrics.gauge(
+        "hf_snapshot_rows",
+        "Rows in the data served",
+        lambda: len(STORE.get().status) if STORE.get().status is not None else 0,
+    )
+    metrics.gauge(
+        "hf_reply_cache_hit_ratio",
+        "Share of replies served from the cache",
+        lambda: REPLY_CACHE.hit_rate(),
+    )
+    metrics.gauge(
+        "hf_reply_cache_entries", "Replies in the cache", lambda: len(REPLY_CACHE)
+    )
+    if pending:
+        metrics.gauge("hf_updates_pending", "Updates being processed", pending)
+    if lytics:
+        metrics.gauge(
+            "hf_analytics_queue_depth",
+            "Usage log rows waiting to be written",
+            lytics.queue.qsize,
+        )
+        metrics.counter(
+            "hf_analytics_rows_written_total",
+            "Usage log rows written",
+            lambda: lytics.written,
+        )
+        metrics.counter(
+            "hf_analytics_rows_spilled_total",
+            "Usage log rows spilled to disk",
+            lambda: lytics.spilled,
+        )
+    if MIRROR:
+        metrics.gauge(
+            "hf_bin_queue_depth", "Events waiting to be mirrored", MIRROR.queue.qsize
+        )
+        metrics.counter(
+            "hf_bin_dropped_total",
+            "Events dropped by the mirror",
+            lambda: MIRROR.dropped,
+        )
+    return metrics.serve(METRICS_PORT)
+
+
+def answer_update(bot, update):
+    """
+    Handle one update and wait for the replies it queued,
+    so the next update of the chat is answered after them
+    """
+    pending = []
+    token = PENDING_SENDS.set(pending)
+    try:
+        handle_update(bot, update)
+    finally:
+        PENDING_SENDS.reset(token)
+        concurrent.futures.wait(pending)
+
+
+def process_update(bot, update, lytics):
+    """
+    Handle one update and log it
+    """
+    logging.info(f"Update ID:{update.update_id + 1}")
+    answer_update(bot, update)
+    # Try logging to Usage Log
+    if lytics:
+        log_usage(lytics, update)
+
+
 def main():
     """
     Run the bot in perpetuity
@@ -587,93 +1343,112 @@ def main():
     except KeyError:
         logging.error("Bot credentials not found in environment")
 
-    bot = telegram.Bot(BOT_TOKEN)
+    bot = telegram.Bot(BOT_TOKEN, base_url=API_URL)
+    start_outbox(bot)
+    start_mirror(bot)
+    STATE.load()
+    STATE.start()
+    start_subscriptions(bot)
+
+    # Serve the last saved data and refresh in the background
+    if load_status_logs() is None:
+        logging.info("Waiting for the first data refresh")
+    refresher = Refresher(refresh_data, DATA_UPDATE_MIN * 60)
+    refresher.start()
+    if STORE.get().status is None:
+        refresher.first_done.wait()
+
+    # Usage logs are written in batches in the background
+    lytics = AnalyticsWriter()
+    lytics.start()
+
+    # Updates are processed concurrently, in order within a chat
+    dispatcher = Dispatcher(
+        lambda update: process_update(bot, update, lytics),
+        n_workers=N_WORKERS,
+        max_pending=MAX_PENDING_UPDATES,
+    )
+    # Skip updates that were processed before a restart
+    dispatcher.restore(STATE.get("offset"), STATE.get("done"))
+    dispatcher.start()
+    start_metrics(pending=dispatcher.pending, lytics=lytics)
+
+    if WEBHOOK_URL:
+        serve_webhook(bot, dispatcher)
+    else:
+        poll(bot, dispatcher)
+
+
+def send_scheduled(bot):
+    """
+    Send the scheduled message if it has been more than specified time interval
+    """
+    scheduled_sent_time = state_time("scheduled_sent_time")
+    logging.debug(f"Last scheduled sent : {STATE.get('scheduled_sent_time')}")
+
+    time_now = datetime.now(IST)
+    if (time_now - scheduled_sent_time) > timedelta(minutes=SCHEDULE_MSG_MIN):
+        if send_to_channel(bot):
+            logging.info("Sent scheduled message to channel")
+        STATE.update(scheduled_sent_time=time_now.strftime(TIME_FORMAT))
 
-    # Do a data refresh every time bot restarts
-    read_status_logs()
-    update_id = 0
 
-    # Try creating and analytics object
+def poll(bot, dispatcher):
+    """
+    Long poll for updates and hand them to the dispatcher
+    """
     try:
-        lytics = Analytics()
+        # Telegram refuses to hand out updates while a webhook is set
+        bot.delete_webhook()
     except Exception as e:
-        logging.error(f"Analytics engine couldn't start : {e}")
-        lytics = None
+        logging.error(f"Couldn't remove the webhook : {e}")
 
     while True:
-        # Send scheduled message if it has been more than specified time interval
-        with open("metadata.json", "r") as f:
-            meta = json.load(f)
-        try:
-            scheduled_sent_time = datetime.strptime(
-                meta["scheduled_sent_time"], "%Y-%m-%d %H:%M:%S%z"
-            )
-            logging.debug(f"Last scheduled sent : {meta['scheduled_sent_time']}")
-        except KeyError:
-            scheduled_sent_time = datetime.strptime(
-                "1900-01-01 00:00:00+05:30", "%Y-%m-%d %H:%M:%S%z"
-            )
-
-        time_now = datetime.now(IST)
-        if (time_now - scheduled_sent_time) > timedelta(minutes=SCHEDULE_MSG_MIN):
-            send_to_channel(bot)
-            logging.info("Sent scheduled message to channel")
-            meta["scheduled_sent_time"] = time_now.strftime("%Y-%m-%d %H:%M:%S%z")
-            with open("metadata.json", "w") as f:
-                json.dump(meta, f, indent=4)
+        send_scheduled(bot)
 
         try:
-            for update in bot.get_updates(offset=update_id, timeout=10):
-                update_id = update.update_id + 1
-                logging.info(f"Update ID:{update_id}")
-                entry(bot, update)
-                # Try logging to Usage Log
-                if lytics:
-                    try:
-                        timestamp = datetime.now(IST).strftime("%Y-%m-%d %H:%M:%S%z")
-                        update_id = update_id
-                        try:
-                            tg_id = update["message"]["chat"]["id"]
-                        except TypeError:
-                            tg_id = ""
-                        try:
-                            tg_username = update["message"]["chat"]["username"]
-                        except TypeError:
-                            tg_username = ""
-                        try:
-                            tg_firstname = update["message"]["chat"]["first_name"]
-                        except TypeError:
-                            tg_firstname = ""
-                        try:
-                            tg_lastname = update["message"]["chat"]["last_name"]
-                        except TypeError:
-                            tg_lastname = ""
-                        try:
-                            text = update["message"]["text"]
-                        except TypeError:
-                            text = ""
-
-                        row = [
-                            [
-                                timestamp,
-                                update_id,
-                                tg_id,
-                                tg_username,
-                                tg_firstname,
-                                tg_lastname,
-                                text,
-                            ]
-                        ]
-                        logging.info(row)
-                        lytics.append_rows(row)
-                    except Exception as e:
-                        logging.error(f"Analytics post failed : {e}")
+            updates = bot.get_updates(offset=dispatcher.offset(), timeout=10)
+            submitted = [u for u in updates if dispatcher.submit(u)]
+            if updates and not submitted:
+                # Only updates still being processed came back
+                dispatcher.wait_for_progress(timeout=1)
+            offset, done = dispatcher.checkpoint()
+            STATE.update(offset=offset, done=done)
 
         except NetworkError:
             sleep(1)
         except Unauthorized:
-            logging.error("User has blocked the bot")
-            update_id = update_id + 1
+            logging.error("Bot is not authorized to get updates")
+            sleep(1)
+
+
+def serve_webhook(bot, dispatcher):
+    """
+    Have Telegram push updates to the embedded server
+    which hands them to the dispatcher
+    """
+    secret = os.environ.get("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+    server = WebhookServer(
+        bot,
+        dispatcher.push,
+        secret,
+        host=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        path=WEBHOOK_PATH,
+    )
+    server.start()
+    bot.set_webhook(
+        url=WEBHOOK_URL,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        secret_token=secret,
+    )
+    logging.info(f"Webhook set to {WEBHOOK_URL}")
+
+    while True:
+        send_scheduled(bot)
+        offset, done = dispatcher.checkpoint()
+        STATE.update(offset=offset, done=done)
+        sleep(10)
 
 
 if __name__ == "__main__":
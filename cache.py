@@ -0,0 +1,58 @@
+import threading
+from collections import OrderedDict
+
+
+class ReplyCache:
+    """
+    LRU cache of rendered replies
+    Keys carry the data version, and entries of older versions
+    are dropped as soon as a newer version is seen
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def _check_version(self, version):
+        if self.version is None or version > self.version:
+            self._entries.clear()
+            self.version = version
+
+    def get(self, key, version):
+        """
+        Return the cached reply for `key` at `version`, None if there is none
+        """
+        with self._lock:
+            self._check_version(version)
+            try:
+                message = self._entries[(key, version)]
+            except KeyError:
+                self.misses = self.misses + 1
+                return None
+            self._entries.move_to_end((key, version))
+            self.hits = self.hits + 1
+            return message
+
+    def put(self, key, version, message):
+        """
+        Cache the reply, evicting the least recently used one if full
+        """
+        with self._lock:
+            self._check_version(version)
+            if version < self.version:
+                return
+            self._entries[(key, version)] = message
+            self._entries.move_to_end((key, version))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self):
+        return len(self._entries)
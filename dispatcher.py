@@ -0,0 +1,183 @@
+import queue
+import threading
+from collections import deque
+
+import logging
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+
+class NotHandled(Exception):
+    """
+    Raised by a handler that could not process an update
+    The update is not counted as done, so polling fetches it again,
+    up to the dispatcher's `max_attempts` before it is dropped
+    """
+
+
+def chat_id_of(update):
+    """
+    Chat an update belongs to, 0 if it has none
+    """
+    chat = update.effective_chat
+    return chat.id if chat else 0
+
+
+class Dispatcher:
+    """
+    Process updates concurrently on a pool of worker threads
+    All updates of a chat go to the same worker, so they are handled in order
+    An update only counts as acknowledged once it, and every update
+    before it, has been processed
+    """
+
+    # Webhook update ids remembered to drop redeliveries
+    SEEN_IDS = 10000
+
+    def __init__(self, handle, n_workers=4, max_pending=100, max_attempts=3):
+        self.handle = handle
+        self.n_workers = n_workers
+        self.max_attempts = max_attempts
+        self._queues = [queue.Queue(maxsize=max_pending) for _ in range(n_workers)]
+        self._progress = threading.Condition()
+        self._in_flight = set()
+        self._done = set()
+        # Times each update was not handled, so one that never can be is dropped
+        self._attempts = {}
+        self._next_offset = 0
+        self._seen = set()
+        self._seen_order = deque()
+        self._threads = []
+
+    def start(self):
+        for i, q in enumerate(self._queues):
+            t = threading.Thread(
+                target=self._work, args=(q,), name=f"worker-{i}", daemon=True
+            )
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, update):
+        """
+        Queue the update on its chat's worker
+        Blocks while that worker is `max_pending` updates behind
+        Returns False for an update that was already dispatched
+        """
+        with self._progress:
+            if update.update_id < self._next_offset:
+                return False
+            if update.update_id in self._done or update.update_id in self._in_flight:
+                # Processed before a restart, or fetched again with
+                # an update before it that was not handled
+                self._next_offset = max(self._next_offset, update.update_id + 1)
+                return False
+            self._in_flight.add(update.update_id)
+            self._next_offset = update.update_id + 1
+        self._queues[chat_id_of(update) % self.n_workers].put(update)
+        return True
+
+    def push(self, update, timeout=1):
+        """
+        Queue an update delivered by webhook
+        These come in any order and Telegram keeps track of what was delivered,
+        so there is no offset to check, only redeliveries are dropped
+        Returns False for a redelivery, raises `queue.Full` if the chat's
+        worker stays `max_pending` updates behind for `timeout` seconds
+        """
+        with self._progress:
+            if update.update_id in self._seen or update.update_id in self._done:
+                return False
+            self._seen.add(update.update_id)
+            self._seen_order.append(update.update_id)
+            if len(self._seen_order) > self.SEEN_IDS:
+                self._seen.discard(self._seen_order.popleft())
+            self._in_flight.add(update.update_id)
+            self._next_offset = max(self._next_offset, update.update_id + 1)
+        try:
+            self._queues[chat_id_of(update) % self.n_workers].put(
+                update, timeout=timeout
+            )
+        except queue.Full:
+            with self._progress:
+                self._in_flight.discard(update.update_id)
+                self._seen.discard(update.update_id)
+            raise
+        return True
+
+    def offset(self):
+        """
+        Offset to pass to `get_updates`
+        Every update below it has been processed
+        """
+        with self._progress:
+            return min(self._in_flight | {self._next_offset})
+
+    def checkpoint(self):
+        """
+        The offset and the ids above it that are already processed
+        Saving both lets a restart skip what is done without losing anything
+        """
+        with self._progress:
+            offset = min(self._in_flight | {self._next_offset})
+            self._done = {i for i in self._done if i >= offset}
+            return offset, sorted(self._done)
+
+    def restore(self, offset, done):
+        """
+        Continue from a checkpoint
+        """
+        with self._progress:
+            self._next_offset = offset
+            self._done = set(done)
+
+    def pending(self):
+        """
+        Number of updates dispatched but not processed yet
+        """
+        with self._progress:
+            return len(self._in_flight)
+
+    def wait_for_progress(self, timeout=None):
+        """
+        Block until some update finishes processing
+        """
+        with self._progress:
+            if self._in_flight:
+                self._progress.wait(timeout)
+
+    def _work(self, q):
+        while True:
+            update = q.get()
+            done = True
+            try:
+                self.handle(update)
+            except NotHandled as e:
+                with self._progress:
+                    attempts = self._attempts.get(update.update_id, 0) + 1
+                    self._attempts[update.update_id] = attempts
+                if attempts < self.max_attempts:
+                    logging.error(f"Update {update.update_id} not handled : {e}")
+                    done = False
+                else:
+                    logging.error(
+                        f"Update {update.update_id} not handled after "
+                        f"{attempts} attempts, dropping it : {e}"
+                    )
+            except Exception as e:
+                logging.error(f"Update {update.update_id} failed : {e}")
+            finally:
+                with self._progress:
+                    self._in_flight.discard(update.update_id)
+                    if done:
+                        self._done.add(update.update_id)
+                        self._attempts.pop(update.update_id, None)
+                    else:
+                        # Fetch it again from here
+                        self._next_offset = min(self._next_offset, update.update_id)
+                        self._seen.discard(update.update_id)
+                    self._progress.notify_all()
+                q.task_done()
@@ -0,0 +1,117 @@
+import csv
+import math
+import os
+
+import logging
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+# Approximate centre of each pincode's main locality
+CENTROID_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pincodes.csv")
+# Kilometres per degree of latitude
+KM_PER_DEGREE = 111.2
+
+
+def load_centroids(path=CENTROID_FILE):
+    """
+    Map of pincode to its (latitude, longitude)
+    Empty if the table can't be read
+    """
+    try:
+        with open(path, "r", newline="") as f:
+            return {
+                row["pincode"].strip(): (
+                    float(row["latitude"]),
+                    float(row["longitude"]),
+                )
+                for row in csv.DictReader(f)
+            }
+    except (OSError, KeyError, ValueError) as e:
+        logging.error(f"Couldn't load pincode centroids from {path} : {e}")
+        return {}
+
+
+CENTROIDS = load_centroids()
+
+
+class GridIndex:
+    """
+    Points bucketed in square cells of `cell_km` a side
+    A query looks at the cells in rings around its own cell,
+    moving outward only until it has enough points
+    """
+
+    def __init__(self, points, cell_km=2.0):
+        """
+        `points` are (key, latitude, longitude)
+        """
+        self.cell_km = cell_km
+        self.cells = {}
+        points = list(points)
+        # Flat projection, close enough within a city
+        mean_lat = sum(p[1] for p in points) / len(points) if points else 0.0
+        self.km_per_lon = KM_PER_DEGREE * math.cos(math.radians(mean_lat))
+        for key, lat, lon in points:
+            x, y = self.project(lat, lon)
+            self.cells.setdefault(self.cell(x, y), []).append((key, x, y))
+        self.bounds = None
+        if self.cells:
+            cells = list(self.cells)
+            self.bounds = (
+                min(i for i, _ in cells),
+                max(i for i, _ in cells),
+                min(j for _, j in cells),
+                max(j for _, j in cells),
+            )
+
+    def project(self, lat, lon):
+        return lon * self.km_per_lon, lat * KM_PER_DEGREE
+
+    def cell(self, x, y):
+        return math.floor(x / self.cell_km), math.floor(y / self.cell_km)
+
+    def _ring(self, ci, cj, r):
+        if r == 0:
+            yield ci, cj
+            return
+        for i in range(ci - r, ci + r + 1):
+            yield i, cj - r
+            yield i, cj + r
+        for j in range(cj - r + 1, cj + r):
+            yield ci - r, j
+            yield ci + r, j
+
+    def nearest(self, lat, lon, k=5, accept=None, max_km=25.0):
+        """
+        Up to `k` (key, distance in km) nearest to the point, closest first
+        Only keys for which `accept` is true count, none beyond `max_km`
+        """
+        if self.bounds is None:
+            return []
+        x, y = self.project(lat, lon)
+        ci, cj = self.cell(x, y)
+        min_i, max_i, min_j, max_j = self.bounds
+        # Stop at the furthest occupied cell or at `max_km`
+        max_ring = min(
+            math.ceil(max_km / self.cell_km),
+            max(ci - min_i, max_i - ci, cj - min_j, max_j - cj),
+        )
+        found = []
+        for r in range(max_ring + 1):
+            for cell in self._ring(ci, cj, r):
+                for key, px, py in self.cells.get(cell, ()):
+                    if accept is not None and not accept(key):
+                        continue
+                    distance = math.hypot(px - x, py - y)
+                    if distance <= max_km:
+                        found.append((distance, key))
+            # Everything outside the rings seen so far is further than this
+            covered = r * self.cell_km
+            if len(found) >= k and sorted(found)[k - 1][0] <= covered:
+                break
+        found.sort()
+        return [(key, distance) for distance, key in found[:k]]
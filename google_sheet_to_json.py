@@ -1,10 +1,32 @@
 # https://gist.github.com/nickjevershed/332d1fa264d1d7d93e95
 
+import codecs
 import json
-import requests
+import os
 
+import http_client
+from http_client import CircuitBreaker, CircuitOpenError
 
-def fetch():
+# Size of the pieces the feed is read and parsed in
+CHUNK_SIZE = 64 * 1024
+# Most of a response kept while looking for the entries
+MAX_HEADER = 1024 * 1024
+
+# Stops hammering the sheet while it keeps failing
+BREAKER = CircuitBreaker(threshold=3, reset_after=5 * 60)
+
+# What the last ingest saw, so the next one only handles the changes
+_last = {
+    "etag": None,
+    "last_modified": None,
+    "hashes": {},
+}
+
+
+def sheet_url():
+    # A copy of the feed served elsewhere, for testing
+    if os.environ.get("SHEET_FEED_URL"):
+        return os.environ["SHEET_FEED_URL"]
     # Sheet key
     key = "1IWjEQGUAQpQfT_wWVDiQqUoK457bE_MnTbpgnBPzTiE"
     # sheet_id = "od6"
@@ -15,29 +37,221 @@ def fetch():
         + key
         + f"/{sheet_id}/public/values?alt=json"
     )
+    return url
 
-    # Lists to store new keys and data
-    newKeys = []
-    newData = []
 
-    # Get json in list format
+def request_headers():
+    """
+    Conditional request headers from the last response
+    """
+    headers = {}
+    if _last["etag"]:
+        headers["If-None-Match"] = _last["etag"]
+    if _last["last_modified"]:
+        headers["If-Modified-Since"] = _last["last_modified"]
+    return headers
+
+
+class EntryParser:
+    """
+    Parse the entries of a list feed out of the raw response, chunk by chunk
+    Only the entry being parsed is held in memory, never the whole feed
+    """
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.text = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.state = "header"
+
+    def feed(self, chunk):
+        """
+        Add a chunk of the response, returns the entries completed by it
+        """
+        self.buf = self.buf + self.text.decode(chunk)
+        entries = []
+
+        if self.state == "header":
+            # Kept whole, close() checks it is a feed if no entries follow
+            if len(self.buf) > MAX_HEADER:
+                raise ValueError("Response is not a sheet feed")
+            start = self.buf.find('"entry"')
+            if start == -1:
+                return entries
+            bracket = self.buf.find("[", start)
+            if bracket == -1:
+                return entries
+            self.buf = self.buf[bracket + 1 :]
+            self.state = "entries"
+
+        pos = 0
+        while self.state == "entries":
+            while pos < len(self.buf) and self.buf[pos] in " \t\r\n,":
+                pos = pos + 1
+            if pos == len(self.buf):
+                break
+            if self.buf[pos] == "]":
+                self.state = "done"
+                break
+            try:
+                entry, pos = self.decoder.raw_decode(self.buf, pos)
+            except json.JSONDecodeError:
+                # The entry continues in the next chunk
+                break
+            entries.append(entry)
+        self.buf = self.buf[pos:]
+        return entries
+
+    def close(self):
+        """
+        Check the response was a complete feed
+        A sheet without rows is a feed with no entries, anything else
+        that never got to the entries, like an error page, is not
+        """
+        if self.state == "entries":
+            raise ValueError("Sheet feed ended in the middle of the entries")
+        if self.state == "header":
+            try:
+                document = json.loads(self.buf + self.text.decode(b"", final=True))
+            except ValueError:
+                raise ValueError("Response is not a sheet feed")
+            if not isinstance(document, dict) or "feed" not in document:
+                raise ValueError("Response is not a sheet feed")
+
 
-    ssContent = requests.get(url).json()
+class Ingest:
+    """
+    Compare streamed entries with the last ingest
+    Changed rows are remapped from gsx$ keys straight into columns
+    """
 
-    # Remap entries from having gsx$-prefixed keys to having no prefix, ie our first row as keys
-    firstrow = ssContent["feed"]["entry"][0]
-    newKeys = [key.replace("gsx$", "") for key in firstrow.keys() if "gsx$" in key]
+    def __init__(self):
+        self.keys = None
+        self.count = 0
+        self.hashes = {}
+        self.upserts = None
+        self.full = not _last["hashes"]
 
-    # Read each row and populate the dictionary
-    for entry in ssContent["feed"]["entry"]:
-        rowData = []
-        for key in newKeys:
-            rowData.append(entry["gsx$" + key]["$t"])
-        newData.append(dict(zip(newKeys, rowData)))
+    def add(self, entry):
+        # Remap entries from having gsx$-prefixed keys to having no prefix, ie our first row as keys
+        if self.keys is None:
+            self.keys = [key.replace("gsx$", "") for key in entry if "gsx$" in key]
+            self.upserts = {key: [] for key in self.keys + ["rowid"]}
+        try:
+            rowid = entry["id"]["$t"]
+        except KeyError:
+            rowid = str(self.count)
+        self.count = self.count + 1
+
+        rowData = [entry["gsx$" + key]["$t"] for key in self.keys]
+        row_hash = hash(tuple(rowData))
+        self.hashes[rowid] = row_hash
+        if _last["hashes"].get(rowid) == row_hash:
+            return
+        for key, value in zip(self.keys, rowData):
+            self.upserts[key].append(value)
+        self.upserts["rowid"].append(rowid)
+
+    def finish(self, headers):
+        """
+        Return what changed, and the state to `remember` once it is applied
+        The changes are None if nothing changed, otherwise a dict with
+        `upserts` : columns of the rows that are new or changed
+        `removed` : ids of rows no longer in the sheet
+        `full`    : True if this is the first ingest and `upserts` has every row
+        """
+        removed = [rowid for rowid in _last["hashes"] if rowid not in self.hashes]
+        state = {
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "hashes": self.hashes,
+        }
+        upserts = self.upserts or {"rowid": []}
+        if not upserts["rowid"] and not removed:
+            return None, state
+        return {"upserts": upserts, "removed": removed, "full": self.full}, state
+
+
+def remember(state):
+    """
+    Base the next fetch on this ingest
+    Only once its changes are applied, or they would never be fetched again
+    """
+    if state is not None:
+        _last.update(state)
+
+
+def fetch_delta():
+    """
+    Stream the sheet and return the changes and the state, see `Ingest.finish`
+    """
+    response = http_client.get(
+        sheet_url(), BREAKER, headers=request_headers(), stream=True
+    )
+    with response:
+        if response.status_code == 304:
+            return None, None
+        response.raise_for_status()
+        parser = EntryParser()
+        ingest = Ingest()
+        try:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                for entry in parser.feed(chunk):
+                    ingest.add(entry)
+            parser.close()
+        except Exception:
+            # A body cut short counts against the sheet too
+            BREAKER.record_failure()
+            raise
+    return ingest.finish(response.headers)
+
+
+async def fetch_delta_async(session):
+    """
+    Same as `fetch_delta` with an aiohttp session
+    """
+    if not BREAKER.allow():
+        raise CircuitOpenError(f"Not fetching the sheet, circuit is {BREAKER.state}")
+    try:
+        async with session.get(sheet_url(), headers=request_headers()) as response:
+            if response.status == 304:
+                BREAKER.record_success()
+                return None, None
+            response.raise_for_status()
+            parser = EntryParser()
+            ingest = Ingest()
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                for entry in parser.feed(chunk):
+                    ingest.add(entry)
+            parser.close()
+    except Exception:
+        BREAKER.record_failure()
+        raise
+    BREAKER.record_success()
+    return ingest.finish(response.headers)
+
+
+def fetch():
+    """
+    Fetch the whole sheet and save it as output.json
+    """
+    newData = []
+    with http_client.get(sheet_url(), BREAKER, stream=True) as response:
+        response.raise_for_status()
+        parser = EntryParser()
+        newKeys = None
+        for chunk in response.iter_content(CHUNK_SIZE):
+            for entry in parser.feed(chunk):
+                if newKeys is None:
+                    newKeys = [
+                        key.replace("gsx$", "") for key in entry if "gsx$" in key
+                    ]
+                newData.append({key: entry["gsx$" + key]["$t"] for key in newKeys})
+        parser.close()
 
     # Saves the json file locally as output.json.
     with open("output.json", "w") as fileOut:
-        json.dump(newData, fileOut, indent=4)
+        json.dump(newData, fileOut)
 
     return newData
 
@@ -0,0 +1,115 @@
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import logging
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+# Seconds to connect, seconds between bytes of the response
+TIMEOUT = (5, 30)
+RETRIES = 3
+BACKOFF = 1
+
+
+class CircuitOpenError(requests.RequestException):
+    """
+    Raised instead of calling an endpoint that keeps failing
+    """
+
+
+class CircuitBreaker:
+    """
+    Stop calling an endpoint after `threshold` failures in a row
+    After `reset_after` seconds one trial call is let through,
+    and its result closes the circuit or opens it again
+    """
+
+    def __init__(self, threshold=5, reset_after=60):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_after:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        """
+        Whether a call may go through now
+        """
+        with self._lock:
+            if self.state == "open":
+                return False
+            if self.state == "half-open":
+                # Let one trial through, hold the rest until it is back
+                self.opened_at = time.monotonic()
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures = self.failures + 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logging.warning(f"Circuit open after {self.failures} failures")
+                self.opened_at = time.monotonic()
+
+
+def make_session(pool_size=4):
+    """
+    Session that keeps connections alive and reuses them
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+SESSION = make_session()
+
+
+def get(url, breaker, session=SESSION, retries=RETRIES, **kwargs):
+    """
+    GET through the circuit breaker, retrying connection errors,
+    timeouts and 5xx/429 responses with jittered exponential backoff
+    The caller must close the returned response
+    """
+    if not breaker.allow():
+        raise CircuitOpenError(f"Not calling {url}, circuit is {breaker.state}")
+    kwargs.setdefault("timeout", TIMEOUT)
+
+    for attempt in range(retries):
+        try:
+            response = session.get(url, **kwargs)
+            if response.status_code < 500 and response.status_code != 429:
+                breaker.record_success()
+                return response
+            response.close()
+            error = requests.HTTPError(f"{url} returned {response.status_code}")
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+        logging.warning(f"GET attempt {attempt + 1} failed : {error}")
+        if attempt + 1 < retries:
+            time.sleep(BACKOFF * 2**attempt * random.uniform(0.5, 1.5))
+
+    breaker.record_failure()
+    raise error
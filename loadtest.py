@@ -0,0 +1,491 @@
+"""
+End-to-end load test of the bot against local stand-ins
+for the Telegram Bot API and the sheet feed
+
+    python loadtest.py --updates 5000 --rate 200 --chats 300
+    python loadtest.py --runtime async --mix zone=1,callback=4
+    python loadtest.py --runtime multiproc --workers 4
+    python loadtest.py --webhook --rate 0
+
+The bot runs unchanged in a child process, in a scratch directory,
+with BIN mirroring, analytics and refreshes on. Analytics has no
+credentials there, so its rows take the retry and spill path
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, deque
+
+import numpy as np
+import aiohttp
+from aiohttp import web
+
+from synthetic import sheet_columns
+from webhook import SECRET_HEADER
+
+import logging
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOKEN = "123:loadtest"
+SCHEDULE_CHANNEL = "@schedule"
+BIN_CHANNEL = "@bin"
+WEBHOOK_SECRET = "loadtest-secret"
+# Like Telegram, at most this many webhook requests at a time
+WEBHOOK_CONNECTIONS = 40
+BEDTYPES = ["General", "HDU", "ICU", "Ventilator-ICU"]
+ERROR_REPLIES = ["Hospital fetch failed", "Something wrong.. :/"]
+# Upper bounds of the latency histogram buckets, in ms
+BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+
+class FakeSheet:
+    """
+    Serves a synthetic sheet as a list feed
+    A few statuses change on every fetch, so every refresh has work to do
+    """
+
+    def __init__(self, n_hospitals, n_logs, changes, seed=1):
+        columns = sheet_columns(n_hospitals, n_logs, seed)
+        self.rnd = random.Random(seed)
+        self.changes = changes
+        self.fetches = 0
+        self.zones = sorted(set(columns["zone"]))
+        self.pincodes = sorted(set(columns["pincode"]))
+        keys = [key for key in columns if key != "rowid"]
+        self.entries = [
+            dict(
+                {"id": {"$t": values[-1]}},
+                **{"gsx$" + key: {"$t": v} for key, v in zip(keys, values)},
+            )
+            for values in zip(*[columns[key] for key in keys + ["rowid"]])
+        ]
+
+    async def handle(self, request):
+        self.fetches = self.fetches + 1
+        for entry in self.rnd.sample(self.entries, self.changes):
+            entry["gsx$general"]["$t"] = str(self.rnd.randrange(20))
+        return web.json_response({"feed": {"entry": self.entries}})
+
+
+class FakeTelegram:
+    """
+    Bot API stand-in that hands out queued updates through getUpdates
+    and matches each reply to the oldest unanswered update of its chat
+    """
+
+    def __init__(self):
+        self.updates = deque()
+        self.next_id = 1
+        self.arrived = asyncio.Event()
+        self.ready = asyncio.Event()
+        self.waiting = {}
+        self.latencies = []
+        self.answered_at = []
+        self.calls = Counter()
+        self.sent = Counter()
+        self.errors = Counter()
+
+    def push(self, update, chat_id):
+        update["update_id"] = self.next_id
+        self.next_id = self.next_id + 1
+        self.updates.append(update)
+        self.waiting.setdefault(chat_id, deque()).append(time.perf_counter())
+        self.arrived.set()
+
+    def unanswered(self):
+        return sum(len(q) for q in self.waiting.values())
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] = self.calls[method] + 1
+        try:
+            body = await request.json()
+        except ValueError:
+            body = dict(await request.post())
+
+        if method == "getUpdates":
+            self.ready.set()
+            return self.ok(await self.get_updates(body))
+        if method == "sendMessage":
+            return self.ok(self.send_message(body))
+        if method in ("sendChatAction", "answerCallbackQuery", "deleteWebhook"):
+            return self.ok(True)
+        if method == "setWebhook":
+            self.ready.set()
+            return self.ok(True)
+        if method == "getMe":
+            return self.ok(
+                {"id": 123, "is_bot": True, "first_name": "Bot", "username": "bot"}
+            )
+        self.errors["unknown method " + method] += 1
+        return web.json_response(
+            {"ok": False, "error_code": 404, "description": "Not Found"}, status=404
+        )
+
+    def ok(self, result):
+        return web.json_response({"ok": True, "result": result})
+
+    async def get_updates(self, body):
+        offset = int(body.get("offset") or 0)
+        # Confirmed updates are gone for good, like on the real API
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()
+        if not self.updates:
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(
+                    self.arrived.wait(), float(body.get("timeout") or 0)
+                )
+            except asyncio.TimeoutError:
+                pass
+        return list(self.updates)[:100]
+
+    def send_message(self, body):
+        now = time.perf_counter()
+        chat_id = body["chat_id"]
+        if chat_id in (SCHEDULE_CHANNEL, BIN_CHANNEL):
+            self.sent[chat_id] += 1
+            # Channels answer with their numeric id
+            chat_id = -1000 - [SCHEDULE_CHANNEL, BIN_CHANNEL].index(chat_id)
+        else:
+            chat_id = int(chat_id)
+            self.sent["replies"] += 1
+            if body.get("text") in ERROR_REPLIES:
+                self.errors["error reply"] += 1
+            waiting = self.waiting.get(chat_id)
+            if waiting:
+                self.latencies.append(now - waiting.popleft())
+                self.answered_at.append(now)
+            else:
+                self.errors["reply to nothing"] += 1
+        return {
+            "message_id": self.sent["replies"] + 1,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": body.get("text", ""),
+        }
+
+
+def parse_mix(mix):
+    """
+    "zone=1,callback=3" as (kinds, weights)
+    """
+    weights = {}
+    for part in mix.split(","):
+        kind, _, weight = part.partition("=")
+        weights[kind.strip()] = float(weight or 1)
+    unknown = set(weights) - {"zone", "pincode", "bedtype", "callback"}
+    if unknown:
+        raise ValueError(f"Unknown update kinds {sorted(unknown)}")
+    return list(weights), list(weights.values())
+
+
+def make_update(kind, chat_id, message_id, rnd, sheet):
+    """
+    A command or, for "callback", a press on one of the command menus
+    """
+    chat = {"id": chat_id, "type": "private", "first_name": f"User {chat_id}"}
+    if kind != "callback":
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": chat,
+            "text": "/" + kind,
+        }
+        return {"message": message}
+
+    command, data = rnd.choice(
+        [
+            ("/zone", rnd.choice(sheet.zones)),
+            ("/pincode", rnd.choice(sheet.pincodes)),
+            ("/bedtype", rnd.choice(BEDTYPES)),
+        ]
+    )
+    return {
+        "callback_query": {
+            "id": str(message_id),
+            "from": {"id": chat_id, "is_bot": False, "first_name": chat["first_name"]},
+            "chat_instance": str(chat_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": chat,
+                "text": "Which one?",
+                "reply_to_message": {
+                    "message_id": message_id - 1,
+                    "date": int(time.time()),
+                    "chat": chat,
+                    "text": command,
+                },
+            },
+        }
+    }
+
+
+async def deliver(session, url, update, slots, errors):
+    """
+    POST the update to the bot's webhook, again while it is too busy
+    """
+    async with slots:
+        for _ in range(10):
+            async with session.post(
+                url, json=update, headers={SECRET_HEADER: WEBHOOK_SECRET}
+            ) as response:
+                if response.status != 503:
+                    break
+            await asyncio.sleep(0.5)
+        if response.status != 200:
+            errors[f"webhook {response.status}"] += 1
+
+
+async def generate(telegram, sheet, args, webhook_url=None):
+    """
+    Offer `args.updates` updates at `args.rate` per second, all at once if 0
+    With `webhook_url` the updates are POSTed there instead of polled
+    """
+    rnd = random.Random(args.seed)
+    kinds, weights = parse_mix(args.mix)
+    session = aiohttp.ClientSession() if webhook_url else None
+    slots = asyncio.Semaphore(WEBHOOK_CONNECTIONS)
+    deliveries = []
+    start = time.perf_counter()
+    for i in range(args.updates):
+        if args.rate > 0:
+            delay = start + i / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        chat_id = rnd.randrange(1, args.chats + 1)
+        kind = rnd.choices(kinds, weights)[0]
+        update = make_update(kind, chat_id, 2 * i + 2, rnd, sheet)
+        telegram.push(update, chat_id)
+        if session:
+            deliveries.append(
+                asyncio.create_task(
+                    deliver(session, webhook_url, update, slots, telegram.errors)
+                )
+            )
+    if session:
+        await asyncio.gather(*deliveries)
+        await session.close()
+    return start
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_bot(args, base_url, workdir, webhook_port=None):
+    env = dict(
+        os.environ,
+        BOT_TOKEN=TOKEN,
+        TELEGRAM_API_URL=base_url + "/bot",
+        SHEET_FEED_URL=base_url + "/feed",
+        SCHEDULE_CHANNEL=SCHEDULE_CHANNEL,
+        BIN_CHANNEL=BIN_CHANNEL,
+        DATA_UPDATE_MIN=str(args.refresh / 60),
+        N_WORKERS=str(args.workers),
+        N_PROCESSES=str(args.workers),
+        SEND_RATE=str(args.send_rate),
+    )
+    if webhook_port:
+        env.update(
+            WEBHOOK_URL="https://bot.invalid/telegram",
+            WEBHOOK_PORT=str(webhook_port),
+            WEBHOOK_PATH="/telegram",
+            WEBHOOK_SECRET=WEBHOOK_SECRET,
+        )
+    script = {"sync": "bot.py", "async": "aio_bot.py", "multiproc": "multiproc_bot.py"}[
+        args.runtime
+    ]
+    log = open(os.path.join(workdir, "bot.log"), "w")
+    return subprocess.Popen(
+        [sys.executable, os.path.join(HERE, script)],
+        cwd=workdir,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+
+
+def stop_bot(process):
+    # SIGINT so the bot's exit handlers flush its state and spill files
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def count_lines(path):
+    try:
+        with open(path, "r") as f:
+            return sum(1 for _ in f)
+    except FileNotFoundError:
+        return 0
+
+
+def summarize(telegram, sheet, args, started, finished, spilled):
+    latencies = np.array(telegram.latencies) * 1000
+    answered = len(latencies)
+    if telegram.answered_at:
+        elapsed = max(telegram.answered_at) - started
+    else:
+        elapsed = finished - started
+    histogram = {}
+    lower = 0
+    for upper in BUCKETS_MS + [float("inf")]:
+        label = f"<{upper}" if upper != float("inf") else f">={lower}"
+        histogram[label] = int(((latencies >= lower) & (latencies < upper)).sum())
+        lower = upper
+
+    result = {
+        "params": vars(args),
+        "offered": args.updates,
+        "answered": answered,
+        "unanswered": telegram.unanswered(),
+        "elapsed_s": elapsed,
+        "throughput_per_s": answered / elapsed if elapsed > 0 else 0.0,
+        "latency_ms": {},
+        "histogram_ms": histogram,
+        "errors": dict(telegram.errors),
+        "api_calls": dict(telegram.calls),
+        "channel_messages": {
+            c: telegram.sent[c] for c in (SCHEDULE_CHANNEL, BIN_CHANNEL)
+        },
+        "sheet_fetches": sheet.fetches,
+        "analytics_spilled": spilled,
+    }
+    if answered:
+        result["latency_ms"] = {
+            f"p{p}": float(np.percentile(latencies, p)) for p in [50, 90, 99, 99.9]
+        }
+        result["latency_ms"]["max"] = float(latencies.max())
+    return result
+
+
+def report(result):
+    print(
+        f"{result['answered']}/{result['offered']} updates answered "
+        f"in {result['elapsed_s']:.1f} s : "
+        f"{result['throughput_per_s']:.1f} updates/s"
+    )
+    print(
+        "latency ms : "
+        + "  ".join(f"{k} {v:.1f}" for k, v in result["latency_ms"].items())
+    )
+    top = max(result["histogram_ms"].values()) or 1
+    for label, count in result["histogram_ms"].items():
+        print(f"  {label:>8} ms {count:8d} " + "#" * round(40 * count / top))
+    print(f"unanswered : {result['unanswered']}, errors : {result['errors'] or 0}")
+    print(
+        f"channel messages : {result['channel_messages']}, "
+        f"sheet fetches : {result['sheet_fetches']}, "
+        f"analytics rows spilled : {result['analytics_spilled']}"
+    )
+
+
+async def run(args):
+    sheet = FakeSheet(args.hospitals, args.logs, args.changes, args.seed)
+    telegram = FakeTelegram()
+    app = web.Application(client_max_size=16 * 1024**2)
+    app.router.add_post("/bot" + TOKEN + "/{method}", telegram.handle)
+    app.router.add_get("/feed", sheet.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", args.port)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    base_url = f"http://{host}:{port}"
+
+    webhook_port = free_port() if args.webhook else None
+    webhook_url = f"http://127.0.0.1:{webhook_port}/telegram" if webhook_port else None
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    process = start_bot(args, base_url, workdir, webhook_port)
+    logging.info(f"Bot started in {workdir}, its log is in bot.log")
+    try:
+        await asyncio.wait_for(telegram.ready.wait(), args.startup_timeout)
+        logging.info("Bot is ready, offering updates")
+        started = await generate(telegram, sheet, args, webhook_url)
+        deadline = time.perf_counter() + args.drain_timeout
+        while telegram.unanswered() and time.perf_counter() < deadline:
+            if process.poll() is not None:
+                logging.error(f"Bot exited with {process.returncode}")
+                break
+            await asyncio.sleep(0.1)
+        finished = time.perf_counter()
+    finally:
+        stop_bot(process)
+        await runner.cleanup()
+
+    spilled = count_lines(os.path.join(workdir, "usage_log_spill.jsonl"))
+    return summarize(telegram, sheet, args, started, finished, spilled)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--runtime", choices=["sync", "async", "multiproc"], default="sync"
+    )
+    parser.add_argument(
+        "--webhook", action="store_true", help="POST updates to the bot's webhook"
+    )
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument(
+        "--rate", type=float, default=100, help="updates/s, 0 for all at once"
+    )
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument(
+        "--mix",
+        default="zone=1,pincode=1,bedtype=1,callback=3",
+        help="relative weights of zone, pincode, bedtype and callback updates",
+    )
+    parser.add_argument("--hospitals", type=int, default=200)
+    parser.add_argument("--logs", type=int, default=20, help="statuses per hospital")
+    parser.add_argument(
+        "--changes", type=int, default=20, help="rows changed per fetch"
+    )
+    parser.add_argument("--refresh", type=float, default=5, help="refresh interval, s")
+    parser.add_argument(
+        "--workers", type=int, default=4, help="worker threads, or processes"
+    )
+    parser.add_argument(
+        "--send-rate", type=float, default=30, help="bot's global send limit, msg/s"
+    )
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    parser.add_argument("--drain-timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="save the results as JSON")
+    args = parser.parse_args()
+    if args.webhook and args.runtime == "async":
+        parser.error("the async runtime has no webhook mode")
+
+    result = asyncio.run(run(args))
+    report(result)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=4)
+        print(f"Saved to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter as _Counts
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import logging
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+# Upper bounds of the latency buckets, in seconds
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key):
+    if not key:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in key) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """
+    A named value per set of labels
+    If `fn` is given the value is read from it on every scrape instead
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, fn=None):
+        self.name = name
+        self.documentation = documentation
+        self.fn = fn
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        if self.fn is not None:
+            try:
+                return [(self.name, (), self.fn())]
+            except Exception as e:
+                logging.error(f"Couldn't read metric {self.name} : {e}")
+                return []
+        with self._lock:
+            if not self._values:
+                return [(self.name, (), 0)]
+            return [(self.name, key, v) for key, v in self._values.items()]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+
+class Histogram(Metric):
+    """
+    Counts of observations per bucket, with their sum and count
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets=BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = list(buckets) + [float("inf")]
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            counts = self._values.setdefault(key, [0] * len(self.buckets) + [0.0])
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    counts[i] = counts[i] + 1
+            counts[-1] = counts[-1] + value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        out = []
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+        for key, counts in values.items():
+            for upper, count in zip(self.buckets, counts):
+                out.append(
+                    (
+                        self.name + "_bucket",
+                        key + (("le", _format_value(upper)),),
+                        count,
+                    )
+                )
+            out.append((self.name + "_sum", key, counts[-1]))
+            out.append((self.name + "_count", key, counts[-2]))
+        return out
+
+
+class Registry:
+    """
+    The metrics of the process, rendered in the Prometheus text format
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Add the metric, or return the one already registered under its name
+        """
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None and metric.fn is None:
+                return existing
+            # A callback registered again reads from the new objects
+            self._metrics[metric.name] = metric
+            return metric
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, key, value in metric.samples():
+                lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, fn=None):
+    return REGISTRY.register(Counter(name, documentation, fn))
+
+
+def gauge(name, documentation, fn=None):
+    return REGISTRY.register(Gauge(name, documentation, fn))
+
+
+def histogram(name, documentation, buckets=BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, buckets))
+
+
+STAGE_SECONDS = histogram(
+    "hf_stage_seconds", "Time spent in each stage of fetching and answering"
+)
+
+
+def timed(stage):
+    """
+    Time a block as one run of `stage`
+    """
+    return STAGE_SECONDS.time(stage=stage)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host="127.0.0.1"):
+    """
+    Serve /metrics from a background thread
+    Returns the server, None if the port can't be bound
+    """
+    try:
+        server = ThreadingHTTPServer((host, port), _Handler)
+    except OSError as e:
+        logging.error(f"Couldn't serve metrics on {host}:{port} : {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+class SlowProfiler:
+    """
+    Sample the stacks of threads inside `watch` every `interval` seconds
+    and log the hottest ones of runs that took over `threshold` seconds
+    Only threads being watched are sampled, nothing runs while idle
+    """
+
+    def __init__(self, threshold, interval=0.005, top=5, depth=12):
+        self.threshold = threshold
+        self.interval = interval
+        self.top = top
+        self.depth = depth
+        self._active = {}
+        self._lock = threading.Lock()
+        self._busy = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    @contextmanager
+    def watch(self, name):
+        record = {"stacks": _Counts(), "start": time.perf_counter()}
+        tid = threading.get_ident()
+        with self._lock:
+            self._active[tid] = record
+            self._busy.set()
+        try:
+            yield
+        finally:
+            with self._lock:
+                del self._active[tid]
+                if not self._active:
+                    self._busy.clear()
+            elapsed = time.perf_counter() - record["start"]
+            if elapsed >= self.threshold:
+                self._report(name, elapsed, record["stacks"])
+
+    def _run(self):
+        while True:
+            self._busy.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for tid, record in self._active.items():
+                    frame = frames.get(tid)
+                    if frame is not None:
+                        record["stacks"][self._collapse(frame)] += 1
+
+    def _collapse(self, frame):
+        stack = traceback.extract_stack(frame)[-self.depth :]
+        return ";".join(
+            f"{f.name}({os.path.basename(f.filename)}:{f.lineno})" for f in stack
+        )
+
+    def _report(self, name, elapsed, stacks):
+        total = sum(stacks.values())
+        lines = [f"{name} took {elapsed:.3f}s, {total} sample(s)"]
+        for stack, count in stacks.most_common(self.top):
+            lines.append(f"  {count / total:6.1%} {stack}")
+        logging.warning("\n".join(lines))
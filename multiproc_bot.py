@@ -0,0 +1,278 @@
+"""
+Run the bot on several processes
+
+The main process polls Telegram (or takes webhook updates), refreshes the
+data and sends the scheduled messages. Each refresh is saved to the
+snapshot file and announced by bumping a shared version number.
+Worker processes memory-map the snapshot file when the version changes
+and handle the updates of their share of the chats
+"""
+
+import atexit
+import multiprocessing
+import os
+import queue
+
+import telegram
+
+import bot
+from analytics import AnalyticsWriter
+from dispatcher import Dispatcher, NotHandled, chat_id_of
+from refresher import Refresher
+from snapshot_file import save_snapshot
+from subscriptions import reshard
+
+import logging
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+N_PROCESSES = int(os.environ.get("N_PROCESSES", os.cpu_count() or 1))
+# Seconds between a worker's checks for new data while it is idle
+CHECK_INTERVAL = 1
+# Workers an update may be tried on before giving up on it
+MAX_TRIES = 3
+
+# Workers are started fresh, not forked from a process running threads
+CONTEXT = multiprocessing.get_context("spawn")
+
+
+class SharedData:
+    """
+    A worker's view of the data published by the main process
+    A new snapshot is only loaded between updates,
+    so every update is served from a single snapshot
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self.seen = None
+        self.state_mtime = None
+
+    def check(self):
+        version = self.version.value
+        if version != self.seen:
+            self.seen = version
+            bot.load_status_logs()
+        # Zones, pincodes and the refresh time are in the main process' state
+        try:
+            mtime = os.stat(bot.STATE.path).st_mtime
+        except FileNotFoundError:
+            return
+        if mtime != self.state_mtime:
+            self.state_mtime = mtime
+            bot.STATE.load()
+            # A refresh that found no changes saves no new snapshot
+            updated_time = bot.state_time("last_updated_time")
+            snapshot = bot.STORE.get()
+            if snapshot.updated_time and updated_time > snapshot.updated_time:
+                bot.STORE.touch(updated_time)
+
+
+def work(index, n_workers, requests, replies, version):
+    """
+    Worker process : handle the updates sent on `requests`
+    and reply with their ids once done, or None once ready
+    """
+    client = telegram.Bot(os.environ["BOT_TOKEN"], base_url=bot.API_URL)
+    # Each worker has its share of the send rate, and all of its chats' sends
+    bot.SEND_RATE = bot.SEND_RATE / (n_workers + 1)
+    bot.start_outbox(client)
+    bot.start_mirror(client)
+    bot.start_subscriptions(client, shard=index, n_shards=n_workers)
+    if bot.METRICS_PORT:
+        bot.METRICS_PORT = bot.METRICS_PORT + 1 + index
+        bot.start_metrics()
+
+    data = SharedData(version)
+    data.check()
+    logging.info(f"Worker {index} serving data v{bot.STORE.get().version}")
+    replies.put(None)
+    try:
+        while True:
+            try:
+                item = requests.get(timeout=CHECK_INTERVAL)
+            except queue.Empty:
+                data.check()
+                continue
+            if item is None:
+                return
+            data.check()
+            update = telegram.Update.de_json(item, client)
+            try:
+                bot.answer_update(client, update)
+            except Exception as e:
+                logging.error(f"Update {update.update_id + 1} failed : {e}")
+            replies.put(update.update_id)
+    except KeyboardInterrupt:
+        pass
+
+
+class WorkerProcess:
+    """
+    Handle to a worker process, restarted if it dies
+    """
+
+    def __init__(self, index, n_workers, version):
+        self.index = index
+        self.n_workers = n_workers
+        self.version = version
+        self.process = None
+
+    def start(self):
+        self.requests = CONTEXT.Queue()
+        self.replies = CONTEXT.Queue()
+        self.process = CONTEXT.Process(
+            target=work,
+            args=(
+                self.index,
+                self.n_workers,
+                self.requests,
+                self.replies,
+                self.version,
+            ),
+            name=f"bot-worker-{self.index}",
+            daemon=True,
+        )
+        self.process.start()
+
+    def wait_ready(self):
+        """
+        Wait for the worker to load the data, returns False if it died
+        """
+        while self.process.is_alive():
+            try:
+                if self.replies.get(timeout=CHECK_INTERVAL) is None:
+                    return True
+            except queue.Empty:
+                pass
+        return False
+
+    def handle(self, update):
+        """
+        Have the worker handle the update, returns once it is done
+        A worker that dies is restarted and the update sent again,
+        raises `NotHandled` if it can't be handled in `MAX_TRIES`
+        """
+        for _ in range(MAX_TRIES):
+            if not self.process.is_alive():
+                logging.error(f"Worker {self.index} is dead, restarting it")
+                self.start()
+                if not self.wait_ready():
+                    continue
+            self.requests.put(update.to_dict())
+            if self._wait_done(update.update_id):
+                return
+            logging.error(f"Worker {self.index} died on update {update.update_id + 1}")
+        raise NotHandled(f"worker {self.index} died {MAX_TRIES} times")
+
+    def _wait_done(self, update_id):
+        """
+        Wait for the worker to finish the update, returns False if it died
+        """
+        while True:
+            try:
+                if self.replies.get(timeout=CHECK_INTERVAL) == update_id:
+                    return True
+            except queue.Empty:
+                if not self.process.is_alive():
+                    return False
+
+
+def stop_workers(workers, timeout=10):
+    """
+    Let the workers finish their updates and send what they queued
+    """
+    for worker in workers:
+        worker.requests.put(None)
+    for worker in workers:
+        worker.process.join(timeout)
+
+
+def process_update(workers, update, lytics):
+    """
+    Hand the update to its chat's worker and log it
+    Called on the dispatcher thread of that worker
+    """
+    logging.info(f"Update ID:{update.update_id + 1}")
+    workers[chat_id_of(update) % len(workers)].handle(update)
+    if lytics:
+        bot.log_usage(lytics, update)
+
+
+def main():
+    try:
+        BOT_TOKEN = os.environ["BOT_TOKEN"]
+    except KeyError:
+        logging.error("Bot credentials not found in environment")
+        return
+
+    client = telegram.Bot(BOT_TOKEN, base_url=bot.API_URL)
+    # The workers have a share of the send rate each, this process the last
+    # one, for the scheduled messages and the mirror of the channel
+    bot.SEND_RATE = bot.SEND_RATE / (N_PROCESSES + 1)
+    bot.start_outbox(client)
+    bot.start_mirror(client)
+    bot.STATE.load()
+    bot.STATE.start()
+    # Each worker keeps the subscriptions of its own chats
+    if reshard(bot.SUBSCRIPTIONS_FILE, N_PROCESSES) is None:
+        logging.error("Subscriptions could not be split between the workers")
+
+    version = CONTEXT.Value("q", 0)
+
+    def refresh():
+        ok = bot.refresh_data()
+        # Saved by the refresh, the workers can load it now
+        version.value = bot.STORE.get().version
+        return ok
+
+    # Serve the last saved data and refresh in the background
+    snapshot = bot.load_status_logs()
+    if snapshot is None:
+        logging.info("Waiting for the first data refresh")
+    else:
+        # It may have come from output.json, which the workers don't read
+        save_snapshot(snapshot, bot.SNAPSHOT_FILE)
+        version.value = snapshot.version
+    refresher = Refresher(refresh, bot.DATA_UPDATE_MIN * 60)
+    refresher.start()
+    if bot.STORE.get().status is None:
+        refresher.first_done.wait()
+
+    workers = [WorkerProcess(i, N_PROCESSES, version) for i in range(N_PROCESSES)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        if not worker.wait_ready():
+            logging.error(f"Worker {worker.index} failed to start")
+            return
+    atexit.register(stop_workers, workers)
+
+    # Usage logs are written in batches in the background
+    lytics = AnalyticsWriter()
+    lytics.start()
+
+    # One dispatcher thread per worker, so a chat's updates stay in order
+    # and an update is only acknowledged once its worker is done with it
+    dispatcher = Dispatcher(
+        lambda update: process_update(workers, update, lytics),
+        n_workers=N_PROCESSES,
+        max_pending=bot.MAX_PENDING_UPDATES,
+    )
+    # Skip updates that were processed before a restart
+    dispatcher.restore(bot.STATE.get("offset"), bot.STATE.get("done"))
+    dispatcher.start()
+    bot.start_metrics(pending=dispatcher.pending, lytics=lytics)
+
+    if bot.WEBHOOK_URL:
+        bot.serve_webhook(client, dispatcher)
+    else:
+        bot.poll(client, dispatcher)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+import atexit
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+import metrics
+
+import logging
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+# Lanes in the order they are served
+USER, CHANNEL, BIN = 0, 1, 2
+LANES = ["user", "channel", "bin"]
+
+# Telegram's limits : about 30 messages a second in all,
+# one a second to a private chat and 20 a minute to a group or channel
+GLOBAL_RATE = 30
+GLOBAL_BURST = 3
+CHAT_RATE = 1
+CHAT_BURST = 3
+GROUP_RATE = 20 / 60
+
+QUEUE_DEPTH = metrics.gauge("hf_outbox_depth", "Messages waiting to be sent, by lane")
+SEND_SECONDS = metrics.histogram(
+    "hf_send_seconds", "Time from queueing a message to it being sent"
+)
+SENDS = metrics.counter("hf_sends_total", "Messages sent, by lane and result")
+COALESCED = metrics.counter(
+    "hf_sends_coalesced_total", "Sends dropped as duplicates of a pending one"
+)
+
+
+class TokenBucket:
+    """
+    Allows `rate` events a second, and bursts of up to `burst`
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        # Nothing goes through before this, e.g. after a flood wait
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """
+        Seconds until a token is available, 0 if one is
+        """
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens = self.tokens - 1
+
+    def idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst and now >= self.blocked_until
+
+
+class _Job:
+    __slots__ = ["chat_id", "lane", "kwargs", "future", "queued", "key", "tries"]
+
+    def __init__(self, chat_id, lane, kwargs, key):
+        self.chat_id = chat_id
+        self.lane = lane
+        self.kwargs = kwargs
+        self.key = key
+        self.future = Future()
+        self.queued = time.monotonic()
+        self.tries = 0
+
+
+class Outbox:
+    """
+    Send messages from a pool of threads within Telegram's rate limits
+    User replies go before channel messages, which go before BIN mirrors
+    Messages to a chat are sent one at a time, in order
+    A message identical to one still waiting for the same chat is not sent twice
+    """
+
+    def __init__(
+        self,
+        bot,
+        n_senders=8,
+        rate=GLOBAL_RATE,
+        burst=GLOBAL_BURST,
+        chat_rate=CHAT_RATE,
+        chat_burst=CHAT_BURST,
+        group_rate=GROUP_RATE,
+        max_retries=3,
+    ):
+        self.bot = bot
+        self.n_senders = n_senders
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(rate, burst)
+        self._buckets = {}
+        # Per lane, the chats with messages waiting, oldest first
+        self._lanes = [OrderedDict() for _ in LANES]
+        self._pending = {}
+        self._sending = set()
+        self._depths = [0 for _ in LANES]
+        self._changed = threading.Condition()
+
+    def start(self):
+        for i in range(self.n_senders):
+            threading.Thread(target=self._run, name=f"sender-{i}", daemon=True).start()
+        atexit.register(self.drain)
+
+    def send(self, chat_id, text, lane=USER, **kwargs):
+        """
+        Queue a message, returns a future of the sent message
+        """
+        kwargs = dict(kwargs, chat_id=chat_id, text=text)
+        key = (chat_id, text, repr(sorted(kwargs.items())))
+        with self._changed:
+            job = self._pending.get(key)
+            if job is not None:
+                COALESCED.inc()
+                return job.future
+            job = _Job(chat_id, lane, kwargs, key)
+            self._pending[key] = job
+            self._lanes[lane].setdefault(chat_id, deque()).append(job)
+            self._count(lane, 1)
+            self._changed.notify()
+        return job.future
+
+    def send_message(self, chat_id, text, **kwargs):
+        """
+        Same as `send` on the BIN lane, for the BIN mirror
+        """
+        return self.send(chat_id, text, lane=BIN, **kwargs)
+
+    def depth(self):
+        return sum(self._depths)
+
+    def _count(self, lane, change):
+        self._depths[lane] = self._depths[lane] + change
+        QUEUE_DEPTH.set(self._depths[lane], lane=LANES[lane])
+
+    def drain(self, timeout=10):
+        """
+        Wait for the queued messages to be sent, up to `timeout` seconds
+        """
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while self.depth() or self._sending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logging.warning(f"{self.depth()} message(s) left unsent")
+                    return False
+                self._changed.wait(remaining)
+        return True
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # Private chats have positive ids, groups and channels don't
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            else:
+                bucket = TokenBucket(self.group_rate, self.chat_burst)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _next_job(self):
+        """
+        Wait for the first job that may be sent now and take it off its queue
+        """
+        with self._changed:
+            while True:
+                now = time.monotonic()
+                wait = None
+                global_wait = self.bucket.wait_time(now)
+                for i, lane in enumerate(self._lanes):
+                    for chat_id, jobs in lane.items():
+                        if chat_id in self._sending:
+                            continue
+                        chat_wait = max(
+                            global_wait, self._chat_bucket(chat_id).wait_time(now)
+                        )
+                        if chat_wait > 0:
+                            wait = chat_wait if wait is None else min(wait, chat_wait)
+                            continue
+                        job = jobs.popleft()
+                        if not jobs:
+                            del lane[chat_id]
+                        del self._pending[job.key]
+                        self._count(i, -1)
+                        self._sending.add(chat_id)
+                        self.bucket.take(now)
+                        self._chat_bucket(chat_id).take(now)
+                        return job
+                self._changed.wait(wait)
+
+    def _done(self, job, retry_after=None):
+        with self._changed:
+            self._sending.discard(job.chat_id)
+            if retry_after is not None:
+                # Back to the front of its chat's queue
+                self._chat_bucket(job.chat_id).blocked_until = (
+                    time.monotonic() + retry_after
+                )
+                lane = self._lanes[job.lane]
+                lane.setdefault(job.chat_id, deque()).appendleft(job)
+                lane.move_to_end(job.chat_id, last=False)
+                self._pending.setdefault(job.key, job)
+                self._count(job.lane, 1)
+            elif len(self._buckets) > 10000:
+                now = time.monotonic()
+                idle = [c for c, b in self._buckets.items() if b.idle(now)]
+                for chat_id in idle:
+                    del self._buckets[chat_id]
+            self._changed.notify_all()
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            job.tries = job.tries + 1
+            lane = LANES[job.lane]
+            try:
+                with metrics.timed("send_message"):
+                    message = self.bot.send_message(**job.kwargs)
+            except RetryAfter as e:
+                logging.warning(f"Flood wait of {e.retry_after}s for {job.chat_id}")
+                SENDS.inc(lane=lane, result="retry")
+                self._done(job, retry_after=e.retry_after)
+                continue
+            except BadRequest as e:
+                self._fail(job, e)
+                continue
+            except NetworkError as e:
+                if job.tries < self.max_retries:
+                    SENDS.inc(lane=lane, result="retry")
+                    self._done(job, retry_after=job.tries)
+                    continue
+                self._fail(job, e)
+                continue
+            except Exception as e:
+                self._fail(job, e)
+                continue
+            SENDS.inc(lane=lane, result="sent")
+            SEND_SECONDS.observe(time.monotonic() - job.queued, lane=lane)
+            self._done(job)
+            job.future.set_result(message)
+
+    def _fail(self, job, error):
+        logging.error(f"Couldn't send to {job.chat_id} : {error}")
+        SENDS.inc(lane=LANES[job.lane], result="failed")
+        self._done(job)
+        job.future.set_exception(error)
@@ -0,0 +1,69 @@
+import threading
+import time
+
+import logging
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+
+class Refresher(threading.Thread):
+    """
+    Run the data refresh on its own thread every `interval` seconds
+    so that request handlers only ever read the last published data
+    """
+
+    def __init__(self, refresh, interval):
+        super().__init__(name="refresher", daemon=True)
+        self.refresh = refresh
+        self.interval = interval
+        self.last_success = None
+        self.failures = 0
+        self.first_done = threading.Event()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            started = time.monotonic()
+            self.run_once()
+            elapsed = time.monotonic() - started
+            self._stop_event.wait(max(0, self.interval - elapsed))
+
+    def run_once(self):
+        """
+        Do one refresh and keep track of how stale the data is
+        """
+        started = time.monotonic()
+        try:
+            ok = self.refresh()
+        except Exception as e:
+            logging.error(f"Refresh failed : {e}")
+            ok = False
+        duration = time.monotonic() - started
+
+        if ok:
+            self.last_success = time.monotonic()
+            self.failures = 0
+            logging.info(f"Refresh took {duration:.2f}s")
+        else:
+            self.failures = self.failures + 1
+            lag = self.lag()
+            if lag is not None and lag > 2 * self.interval:
+                logging.warning(
+                    f"Data is {lag:.0f}s old after {self.failures} failed refresh(es)"
+                )
+        self.first_done.set()
+
+    def lag(self):
+        """
+        Seconds since the last successful refresh, None if there was none yet
+        """
+        if self.last_success is None:
+            return None
+        return time.monotonic() - self.last_success
+
+    def stop(self):
+        self._stop_event.set()
@@ -0,0 +1,63 @@
+import re
+
+import numpy as np
+
+
+def normalize(text):
+    """
+    Lower case words, without punctuation
+    """
+    return " ".join(re.sub(r"[^0-9a-z]+", " ", str(text).lower()).split())
+
+
+def trigrams(text):
+    """
+    Set of the trigrams of every word, padded so that
+    the start and end of words count too
+    """
+    grams = set()
+    for word in normalize(text).split():
+        padded = "  " + word + " "
+        for i in range(len(padded) - 2):
+            grams.add(padded[i : i + 3])
+    return grams
+
+
+class TrigramIndex:
+    """
+    Index of names by their trigrams, for search that tolerates typos
+    Built once per data version, the query's trigrams are counted
+    against the names through the index rather than by a scan
+    """
+
+    def __init__(self, names):
+        self.names = list(names)
+        postings = {}
+        sizes = []
+        for i, name in enumerate(self.names):
+            grams = trigrams(name)
+            sizes.append(len(grams))
+            for gram in grams:
+                postings.setdefault(gram, []).append(i)
+        self.sizes = np.array(sizes, dtype="int32")
+        self.postings = {
+            gram: np.array(ids, dtype="int32") for gram, ids in postings.items()
+        }
+
+    def search(self, query, limit=5, min_score=0.4):
+        """
+        The names most similar to `query`, best first, with their score
+        A name scores by the share of the query's trigrams it has,
+        ties go to the name with the fewest other trigrams
+        """
+        grams = trigrams(query)
+        hits = [self.postings[gram] for gram in grams if gram in self.postings]
+        if not hits:
+            return []
+        shared = np.bincount(np.concatenate(hits), minlength=len(self.names))
+        candidates = np.flatnonzero(shared >= min_score * len(grams))
+        shared = shared[candidates]
+        score = shared / len(grams)
+        overlap = shared / (len(grams) + self.sizes[candidates] - shared)
+        best = np.lexsort((-overlap, -score))[:limit]
+        return [(self.names[candidates[i]], float(score[i])) for i in best]
@@ -0,0 +1,188 @@
+import copy
+import threading
+
+from geo import CENTROIDS, GridIndex
+from search import TrigramIndex
+
+import logging
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+
+LOG_COLS = [
+    "timestamp",
+    "general",
+    "hdu",
+    "icu",
+    "icuwithventilator",
+    "phonenumber",
+    "remarks",
+]
+
+BED_COLS = ["general", "hdu", "icu", "icuwithventilator"]
+
+
+def latest_by_hospital(status, n_latest=1):
+    """
+    The `n_latest` status logs of every hospital, newest first
+    Rows without a parsable timestamp come last
+    """
+    s = status.sort_values(
+        ["hospital", "timestamp"],
+        ascending=[True, False],
+        na_position="last",
+        kind="stable",
+    )
+    return s.groupby("hospital", sort=False, observed=True).head(n_latest)
+
+
+def build_index(keys, hospitals):
+    """
+    Map of each key to the hospitals having it, in the order given
+    """
+    index = {}
+    for key, hosp in zip(keys, hospitals):
+        index.setdefault(key, []).append(hosp)
+    return index
+
+
+def changed_hospitals(old, new):
+    """
+    Map of each hospital whose latest bed counts differ between
+    two snapshots to the bed types that changed
+    Hospitals not in the old snapshot have all their bed types changed
+    """
+    if old.status is None or new.status is None:
+        return {}
+    before = old.latest_logs(1)
+    changed = {}
+    for hosp, logs in new.latest_logs(1).items():
+        previous = before.get(hosp)
+        beds = [
+            bed
+            for bed in BED_COLS
+            if previous is None or previous[0][bed] != logs[0][bed]
+        ]
+        if beds:
+            changed[hosp] = beds
+    return changed
+
+
+class Snapshot:
+    """
+    The cleaned status table at one data version
+    A snapshot is never modified after it is published
+    Derived views are computed once per snapshot on first use
+    """
+
+    def __init__(self, status=None, version=0, updated_time=None):
+        self.status = status
+        self.version = version
+        self.updated_time = updated_time
+        self._lock = threading.Lock()
+        self._latest_logs = {}
+        self.by_zone = {}
+        self.by_pincode = {}
+        self.by_bedtype = {bed: [] for bed in BED_COLS}
+        self.zone_of = {}
+        self.pincode_of = {}
+        # Same as sets, and "any" for hospitals with a bed of any type
+        self.has_beds = {bed: set() for bed in BED_COLS + ["any"]}
+        self.by_name = TrigramIndex([])
+        self.by_location = GridIndex([])
+        if status is not None:
+            self.build_indexes()
+
+    def build_indexes(self):
+        """
+        Index hospitals by zone, by pincode, by the bed types
+        available in their latest status, by name, and by the location
+        of their pincode
+        """
+        latest = latest_by_hospital(self.status, n_latest=1)
+        self.by_zone = build_index(latest["zone"], latest["hospital"])
+        self.by_pincode = build_index(latest["pincode"], latest["hospital"])
+        self.zone_of = dict(zip(latest["hospital"], latest["zone"]))
+        self.pincode_of = dict(zip(latest["hospital"], latest["pincode"]))
+        for bed in BED_COLS:
+            self.by_bedtype[bed] = list(latest["hospital"][latest[bed] > 0])
+            self.has_beds[bed] = set(self.by_bedtype[bed])
+        self.has_beds["any"] = set().union(*[self.has_beds[bed] for bed in BED_COLS])
+        self.by_name = TrigramIndex(latest["hospital"])
+        self.by_location = GridIndex(
+            (hosp, *CENTROIDS[pincode])
+            for hosp, pincode in zip(latest["hospital"], latest["pincode"])
+            if pincode in CENTROIDS
+        )
+
+    def latest_logs(self, n_latest=1):
+        """
+        Map of hospital to its `n_latest` status logs as records, newest first
+        """
+        if self.status is None:
+            return {}
+        with self._lock:
+            if n_latest not in self._latest_logs:
+                latest = latest_by_hospital(self.status, n_latest)
+                logs = {}
+                for hosp, record in zip(
+                    latest["hospital"], latest[LOG_COLS].to_dict("records")
+                ):
+                    logs.setdefault(hosp, []).append(record)
+                self._latest_logs[n_latest] = logs
+            return self._latest_logs[n_latest]
+
+
+class SnapshotStore:
+    """
+    Process-wide holder of the current snapshot
+    Readers take a reference with `get()`, a refresh swaps in a new one with `publish()`
+    Listeners are called with the old and new snapshot after each swap
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = Snapshot()
+        self._listeners = []
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def get(self):
+        """
+        Current snapshot. Reading the reference is atomic, no lock needed
+        """
+        return self._snapshot
+
+    def publish(self, status, updated_time=None, version=None):
+        """
+        Swap in a new snapshot with the next version number
+        or `version` if that is higher, e.g. when restoring a saved snapshot
+        """
+        with self._lock:
+            version = max(self._snapshot.version + 1, version or 0)
+            snapshot = Snapshot(status, version, updated_time)
+            old, self._snapshot = self._snapshot, snapshot
+        logging.info(f"Published data snapshot v{snapshot.version}")
+        for listener in self._listeners:
+            try:
+                listener(old, snapshot)
+            except Exception as e:
+                logging.error(f"Snapshot listener failed : {e}")
+        return snapshot
+
+    def touch(self, updated_time):
+        """
+        Mark the current data as still current at `updated_time`,
+        when a refresh found nothing changed
+        The version stays the same, so nothing derived from it is stale
+        """
+        with self._lock:
+            snapshot = copy.copy(self._snapshot)
+            snapshot.updated_time = updated_time
+            self._snapshot = snapshot
+        return snapshot
@@ -0,0 +1,179 @@
+import json
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import logging
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+# File layout
+#   magic | format version (u32) | header length (u32) | JSON header | arrays
+# Every array starts on an ALIGN byte boundary so it can be read
+# straight out of the memory map. Categorical columns are stored as
+# integer codes into their categories, kept in the header. Other text
+# columns are a blob of UTF-8 and the offsets of each value in it
+MAGIC = b"HFSNAP\r\n"
+FORMAT_VERSION = 2
+PREFIX = struct.Struct("<8sII")
+ALIGN = 64
+
+
+def _pad(n):
+    return -n % ALIGN
+
+
+def _encode(series):
+    """
+    Column as a list of numpy arrays and its header entry
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return [series.cat.codes.to_numpy()], {
+            "kind": "category",
+            "categories": [str(c) for c in series.cat.categories],
+        }
+    if pd.api.types.is_datetime64_any_dtype(series):
+        values = series.to_numpy()
+        return [values.view("int64")], {"kind": "datetime", "unit": values.dtype.str}
+    if pd.api.types.is_integer_dtype(series) or pd.api.types.is_float_dtype(series):
+        return [series.to_numpy()], {"kind": "number"}
+    encoded = [value.encode() for value in series.astype(str)]
+    offsets = np.zeros(len(encoded) + 1, dtype="int64")
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    blob = np.frombuffer(b"".join(encoded), dtype="uint8")
+    return [offsets, blob], {"kind": "text"}
+
+
+def _decode(arrays, entry):
+    if entry["kind"] == "category":
+        return pd.Categorical.from_codes(arrays[0], entry["categories"])
+    if entry["kind"] == "datetime":
+        return arrays[0].view(entry["unit"])
+    if entry["kind"] == "text":
+        offsets, blob = arrays
+        blob = blob.tobytes()
+        offsets = offsets.tolist()
+        return pd.Series(
+            [blob[a:b].decode() for a, b in zip(offsets[:-1], offsets[1:])],
+            dtype=object,
+        ).astype(str)
+    return arrays[0]
+
+
+def save_snapshot(snapshot, path):
+    """
+    Write the snapshot to `path`, atomically
+    """
+    arrays = []
+    columns = []
+    offset = 0
+    for name in snapshot.status.columns:
+        values_list, entry = _encode(snapshot.status[name])
+        entry["name"] = name
+        entry["arrays"] = []
+        for values in values_list:
+            values = np.ascontiguousarray(values)
+            entry["arrays"].append(
+                {"dtype": values.dtype.str, "offset": offset, "nbytes": values.nbytes}
+            )
+            arrays.append(values)
+            offset = offset + values.nbytes + _pad(values.nbytes)
+        columns.append(entry)
+
+    crc = 0
+    for values in arrays:
+        crc = zlib.crc32(values.tobytes(), crc)
+    header = json.dumps(
+        {
+            "version": snapshot.version,
+            "updated_time": (
+                snapshot.updated_time.isoformat() if snapshot.updated_time else None
+            ),
+            "rows": len(snapshot.status),
+            "columns": columns,
+            "crc32": crc,
+        }
+    ).encode()
+    header = header + b" " * _pad(PREFIX.size + len(header))
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(PREFIX.pack(MAGIC, FORMAT_VERSION, len(header)))
+            f.write(header)
+            for values in arrays:
+                f.write(values.tobytes())
+                f.write(b"\0" * _pad(values.nbytes))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def load_snapshot(path, columns=None):
+    """
+    Read a snapshot written by `save_snapshot`
+    Returns the status table, its version and update time,
+    or None if the file is missing, from another format version,
+    corrupt, or does not have the expected `columns`
+    """
+    try:
+        with open(path, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError) as e:
+        logging.info(f"No snapshot to load from {path} : {e}")
+        return None
+
+    try:
+        magic, format_version, header_len = PREFIX.unpack_from(buf, 0)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError(f"format {format_version} is not {FORMAT_VERSION}")
+        header = json.loads(bytes(buf[PREFIX.size : PREFIX.size + header_len]))
+        body = PREFIX.size + header_len
+        if columns is not None and [c["name"] for c in header["columns"]] != list(
+            columns
+        ):
+            raise ValueError("columns don't match")
+
+        crc = 0
+        data = {}
+        for entry in header["columns"]:
+            arrays = []
+            for array in entry["arrays"]:
+                start = body + array["offset"]
+                if start + array["nbytes"] > len(buf):
+                    raise ValueError("file is truncated")
+                dtype = np.dtype(array["dtype"])
+                values = np.frombuffer(
+                    buf,
+                    dtype=dtype,
+                    count=array["nbytes"] // dtype.itemsize,
+                    offset=start,
+                )
+                crc = zlib.crc32(values, crc)
+                arrays.append(values)
+            data[entry["name"]] = _decode(arrays, entry)
+        if crc != header["crc32"]:
+            raise ValueError("checksum mismatch")
+    except (ValueError, KeyError, struct.error) as e:
+        logging.error(f"Rejected snapshot {path} : {e}")
+        return None
+
+    status = pd.DataFrame(data)
+    updated_time = header["updated_time"]
+    if updated_time is not None:
+        updated_time = datetime.fromisoformat(updated_time)
+    return status, header["version"], updated_time
@@ -0,0 +1,108 @@
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+
+import logging
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+
+def atomic_write_json(path, obj):
+    """
+    Write the JSON to a temp file next to `path` and rename it over `path`
+    so a crash never leaves a half written file
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(obj, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class StateStore:
+    """
+    Bot state kept in memory, loaded once and written behind to a JSON file
+    Changes made within `delay` seconds of each other are written together
+    """
+
+    def __init__(self, path, defaults=None, delay=1.0):
+        self.path = path
+        self.delay = delay
+        self._data = dict(defaults or {})
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._thread = None
+
+    def load(self):
+        """
+        Read the state file over the defaults
+        """
+        try:
+            with open(self.path, "r") as f:
+                saved = json.load(f)
+        except Exception as e:
+            logging.error(e)
+            logging.info(f"Will create a new {self.path}")
+            return
+        with self._lock:
+            self._data.update(saved)
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def update(self, **values):
+        """
+        Change the state in memory and schedule a write
+        """
+        with self._lock:
+            if all(self._data.get(k) == v for k, v in values.items()):
+                return
+            self._data.update(values)
+        self._dirty.set()
+        if self._thread is None:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the state now if it changed
+        """
+        with self._write_lock:
+            with self._lock:
+                if not self._dirty.is_set():
+                    return
+                self._dirty.clear()
+                data = dict(self._data)
+            try:
+                atomic_write_json(self.path, data)
+            except Exception as e:
+                logging.error(f"Couldn't save {self.path} : {e}")
+                self._dirty.set()
+
+    def start(self):
+        """
+        Write changes from a background thread from now on
+        """
+        self._thread = threading.Thread(target=self._run, name="state", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._dirty.wait()
+            # Let more changes pile up before writing
+            time.sleep(self.delay)
+            self.flush()
@@ -0,0 +1,165 @@
+import glob
+import json
+import os
+import threading
+
+from state import atomic_write_json
+
+import logging
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+KINDS = ["zone", "pincode", "bedtype"]
+
+
+def shard_path(path, index, n_shards):
+    """
+    File of the chats in shard `index`, `path` itself when there is one shard
+    """
+    if n_shards == 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}-{index}{ext}"
+
+
+def reshard(path, n_shards):
+    """
+    Split the subscriptions saved in `path` and in the shards of an earlier
+    run into `n_shards` files, a chat going to shard `chat_id % n_shards`
+    The new files are all written before the old ones are removed,
+    so a crash at any point loses nothing
+    Returns the paths of the shards
+    """
+    root, ext = os.path.splitext(path)
+    old_paths = [p for p in [path] + glob.glob(f"{root}-*{ext}") if os.path.exists(p)]
+    rows = set()
+    for old_path in old_paths:
+        try:
+            with open(old_path, "r") as f:
+                rows.update(
+                    (chat_id, kind, value) for chat_id, kind, value in json.load(f)
+                )
+        except Exception as e:
+            logging.error(f"Couldn't load {old_path} : {e}")
+            # Keep it around rather than lose its subscriptions
+            return None
+
+    paths = [shard_path(path, i, n_shards) for i in range(n_shards)]
+    for i, new_path in enumerate(paths):
+        atomic_write_json(
+            new_path,
+            [list(row) for row in sorted(rows, key=str) if row[0] % n_shards == i],
+        )
+    for old_path in set(old_paths) - set(paths):
+        os.remove(old_path)
+    return paths
+
+
+class Subscriptions:
+    """
+    Which chats want to hear about which zone, pincode or bed type
+    Indexed by topic, so finding the chats for a change never
+    looks at the other subscriptions
+    Saved to `path` on every change
+    """
+
+    def __init__(self, path, max_per_chat=10):
+        self.path = path
+        self.max_per_chat = max_per_chat
+        self._by_topic = {}
+        self._by_chat = {}
+        self._lock = threading.Lock()
+        # Writes are in order, a stale copy never replaces a newer one
+        self._write_lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                rows = json.load(f)
+        except FileNotFoundError:
+            logging.info(f"No subscriptions yet, will create {self.path}")
+            return
+        except Exception as e:
+            logging.error(f"Couldn't load {self.path} : {e}")
+            return
+        with self._lock:
+            for chat_id, kind, value in rows:
+                self._add(chat_id, (kind, value))
+        logging.info(f"Loaded {len(rows)} subscription(s)")
+
+    def save(self):
+        with self._write_lock:
+            with self._lock:
+                rows = [
+                    [chat_id, kind, value]
+                    for chat_id, topics in self._by_chat.items()
+                    for kind, value in sorted(topics)
+                ]
+            try:
+                atomic_write_json(self.path, rows)
+            except Exception as e:
+                logging.error(f"Couldn't save {self.path} : {e}")
+
+    def _add(self, chat_id, topic):
+        self._by_topic.setdefault(topic, set()).add(chat_id)
+        self._by_chat.setdefault(chat_id, set()).add(topic)
+
+    def _remove(self, chat_id, topic):
+        chats = self._by_topic.get(topic)
+        if chats is not None:
+            chats.discard(chat_id)
+            if not chats:
+                del self._by_topic[topic]
+        topics = self._by_chat.get(chat_id)
+        if topics is not None:
+            topics.discard(topic)
+            if not topics:
+                del self._by_chat[chat_id]
+
+    def subscribe(self, chat_id, kind, value):
+        """
+        Returns False if the chat already has `max_per_chat` subscriptions
+        """
+        with self._lock:
+            topics = self._by_chat.get(chat_id, set())
+            if (kind, value) in topics:
+                return True
+            if len(topics) >= self.max_per_chat:
+                return False
+            self._add(chat_id, (kind, value))
+        self.save()
+        return True
+
+    def unsubscribe(self, chat_id, kind=None, value=None):
+        """
+        Drop one subscription of the chat, or all of them if no topic is given
+        Returns the number dropped
+        """
+        with self._lock:
+            topics = set(self._by_chat.get(chat_id, ()))
+            if kind is not None:
+                topics = topics & {(kind, value)}
+            for topic in topics:
+                self._remove(chat_id, topic)
+        if topics:
+            self.save()
+        return len(topics)
+
+    def topics(self, chat_id):
+        with self._lock:
+            return sorted(self._by_chat.get(chat_id, ()))
+
+    def chats(self, topic):
+        """
+        Chats subscribed to the (kind, value) topic
+        """
+        with self._lock:
+            return set(self._by_topic.get(topic, ()))
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(chats) for chats in self._by_topic.values())
@@ -0,0 +1,86 @@
+import random
+from datetime import datetime, timedelta
+
+ZONES = [
+    "BOMMANAHALLI",
+    "DASARAHALLI",
+    "EAST",
+    "MAHADEVAPURA",
+    "RR NAGAR",
+    "SOUTH",
+    "WEST",
+    "YELAHANKA",
+]
+TYPES = ["Covid", "Both", "Non-Covid"]
+FIRST_PINCODE = 560001
+N_PINCODES = 110
+START_TIME = datetime(2021, 4, 10, 8, 0, 0)
+
+
+def sheet_columns(n_hospitals=500, n_logs=200, seed=1):
+    """
+    A synthetic status sheet, as the columns of text the feed has
+    Every hospital logs `n_logs` statuses, so the sheet has
+    `n_hospitals * n_logs` rows
+    """
+    rnd = random.Random(seed)
+    columns = {
+        key: []
+        for key in [
+            "hospitalname",
+            "zone",
+            "pincode",
+            "contactno",
+            "general",
+            "hdu",
+            "icu",
+            "icu-v",
+            "remarks",
+            "timestamp",
+            "type",
+            "interested",
+            "rowid",
+        ]
+    }
+    hospitals = []
+    for h in range(n_hospitals):
+        hospitals.append(
+            (
+                f"Hospital {h}",
+                ZONES[h % len(ZONES)],
+                str(FIRST_PINCODE + rnd.randrange(N_PINCODES)),
+                f"98{rnd.randrange(10**8):08d}" if rnd.random() < 0.8 else "",
+                rnd.choices(TYPES, weights=[6, 3, 1])[0],
+            )
+        )
+
+    row = 0
+    for i in range(n_logs):
+        for name, zone, pincode, phone, hosp_type in hospitals:
+            ts = START_TIME + timedelta(minutes=10 * i + rnd.randrange(10))
+            columns["hospitalname"].append(name)
+            columns["zone"].append(zone)
+            columns["pincode"].append(pincode)
+            columns["contactno"].append(phone)
+            columns["general"].append(str(rnd.randrange(20)))
+            columns["hdu"].append(rnd.choice(["-", "", "0", str(rnd.randrange(5))]))
+            columns["icu"].append(str(rnd.randrange(4)))
+            columns["icu-v"].append(rnd.choice(["-", "0", "1"]))
+            columns["remarks"].append("" if rnd.random() < 0.9 else "Call first")
+            columns["timestamp"].append(
+                f"{ts.month}/{ts.day}/{ts.year} {ts.strftime('%H:%M:%S')}"
+            )
+            columns["type"].append(hosp_type)
+            columns["interested"].append("Yes" if rnd.random() < 0.95 else "No")
+            columns["rowid"].append(f"r{row}")
+            row = row + 1
+    return columns
+
+
+def sheet_rows(n_hospitals=500, n_logs=200, seed=1):
+    """
+    The synthetic sheet as a list of rows, like output.json
+    """
+    columns = sheet_columns(n_hospitals, n_logs, seed)
+    keys = list(columns)
+    return [dict(zip(keys, values)) for values in zip(*columns.values())]
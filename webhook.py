@@ -0,0 +1,142 @@
+"""
+Receive Telegram updates over HTTP instead of polling for them
+
+    python webhook.py updates.jsonl --url http://127.0.0.1:8080/telegram --secret s
+
+replays recorded updates, one JSON update per line, to a running bot
+"""
+
+import argparse
+import hmac
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+import telegram
+
+from http_client import make_session
+
+import logging
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# Updates are small, anything bigger is not from Telegram
+MAX_BODY = 1024 * 1024
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep connections open, Telegram sends many updates over each
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        if self.path.split("?")[0] != server.path:
+            self.reply(404)
+            return
+        secret = self.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(secret.encode(), server.secret.encode()):
+            self.reply(403)
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_BODY:
+            self.reply(413)
+            return
+
+        try:
+            data = json.loads(self.rfile.read(length))
+            update = telegram.Update.de_json(data, server.bot)
+            if update is None:
+                raise ValueError("empty update")
+        except Exception as e:
+            logging.error(f"Bad webhook update : {e}")
+            self.reply(400)
+            return
+
+        try:
+            server.submit(update)
+        except queue.Full:
+            # Telegram delivers it again later
+            logging.warning(f"Too busy for update {update.update_id}")
+            self.reply(503)
+            return
+        self.reply(200)
+
+    def reply(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        if status != 200:
+            # The body may not have been read, don't reuse the connection
+            self.send_header("Connection", "close")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """
+    HTTP server that takes updates POSTed by Telegram to `path`
+    Each connection has its own thread, an update is acknowledged
+    as soon as it is queued with `submit`
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, bot, submit, secret, host="127.0.0.1", port=8080, path="/"):
+        super().__init__((host, port), _Handler)
+        self.bot = bot
+        self.submit = submit
+        self.secret = secret
+        self.path = path
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="webhook", daemon=True).start()
+        host, port = self.server_address[:2]
+        logging.info(f"Receiving updates on http://{host}:{port}{self.path}")
+
+
+def replay(path, url, secret, concurrency=8):
+    """
+    POST the recorded updates in `path` to a webhook
+    Returns the count of responses by status
+    """
+    with open(path, "r") as f:
+        updates = [line for line in f if line.strip()]
+    session = make_session(concurrency)
+    headers = {SECRET_HEADER: secret, "Content-Type": "application/json"}
+
+    def post(body):
+        try:
+            return session.post(url, data=body.encode(), headers=headers).status_code
+        except requests.RequestException as e:
+            logging.error(e)
+            return None
+
+    statuses = {}
+    with ThreadPoolExecutor(concurrency) as pool:
+        for status in pool.map(post, updates):
+            statuses[status] = statuses.get(status, 0) + 1
+    return statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("updates", help="file of recorded updates, one per line")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/telegram")
+    parser.add_argument("--secret", required=True)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+    print(replay(args.updates, args.url, args.secret, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()